@@ -105,6 +105,18 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Executor threads keep their connection between calls.
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+            # Executor threads write concurrently. A deferred transaction that
+            # reads before writing (mark_conversation_read, save_messages)
+            # fails at once with "database is locked" when its lock upgrade
+            # collides; taking the write lock at BEGIN makes it wait out the
+            # timeout instead.
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -129,7 +141,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
@@ -212,16 +224,103 @@ SIMPLE_JWT = {
 
 
 
+CHAT_REDIS_URL = os.getenv('CHAT_REDIS_URL', 'redis://127.0.0.1:6379/1')
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": "redis://127.0.0.1:6379/1",
+        "LOCATION": CHAT_REDIS_URL,
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
     }
 }
 
+# Authenticated users are cached in Redis for TTL seconds, with a per-process
+# LRU of LOCAL_MAX_SIZE users in front that holds entries for LOCAL_TTL.
+USER_CACHE = {
+    'TTL': 300,
+    'LOCAL_TTL': 30,
+    'LOCAL_MAX_SIZE': 10000,
+}
+
+# Consumer and WebSocket auth queries run on a pool of MAX_WORKERS threads
+# (see chatapp.db) instead of the single thread-sensitive executor.
+CHAT_DB_EXECUTOR = {
+    'MAX_WORKERS': int(os.getenv('CHAT_DB_EXECUTOR_WORKERS', '8')),
+}
+
+# Write-behind message persistence. Consumers hand messages to a per-process
+# batcher that bulk inserts every MAX_DELAY_MS or MAX_BATCH rows.
+# DURABILITY "commit" acks after the batch is written, "enqueue" acks as soon
+# as the message is queued with an id reserved from the table's sequence
+# (PostgreSQL or SQLite); a failed write is then reported to the sender.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('CHAT_WRITE_BEHIND', 'false').lower() == 'true',
+    'MAX_BATCH': 100,
+    'MAX_DELAY_MS': 5,
+    'DURABILITY': os.getenv('CHAT_WRITE_BEHIND_DURABILITY', 'commit'),
+    'ID_BLOCK_SIZE': 100,
+}
+
+# Unread replay on connect: at most LIMIT messages in CHUNK_SIZE frames, the
+# rest is paged over HTTP with ?unread=true&after=<cursor>.
+CHAT_UNREAD_REPLAY = {
+    'LIMIT': 200,
+    'CHUNK_SIZE': 50,
+}
+
+# Typing indicators: at most one state change per MIN_INTERVAL seconds per
+# socket, and "typing" is cleared server-side after EXPIRE seconds of silence.
+CHAT_TYPING = {
+    'MIN_INTERVAL': 1.0,
+    'EXPIRE': 5.0,
+}
+
+# Multiplexed sockets (ws/chat/) subscribe to conversations in-band; one
+# socket may hold at most MAX_SUBSCRIPTIONS rooms.
+CHAT_MULTIPLEX = {
+    'MAX_SUBSCRIPTIONS': 100,
+}
+
+# Outbound frames per socket are queued and written by one task, which waits
+# while the client's transport write buffer is full. Past MAX_FRAMES queued
+# frames, ephemeral frames are dropped, superseded ones coalesced, and if
+# that isn't enough the socket is closed with a resume hint.
+CHAT_SEND_QUEUE = {
+    'MAX_FRAMES': 500,
+}
+
+# Per-user token buckets for inbound WebSocket frames, shared across
+# workers through Redis: RATE tokens per second, bursts of up to BURST.
+# Typing frames are left out: the session already throttles and coalesces
+# them, and an error frame per keystroke would cost more than the frame.
+CHAT_RATE_LIMITS = {
+    'chat_message': {'RATE': 1.0, 'BURST': 10},
+    'image': {'RATE': 0.2, 'BURST': 3},
+    'read': {'RATE': 2.0, 'BURST': 10},
+}
+
+# Notifications are buffered per recipient and written as one digest per
+# DIGEST_WINDOW seconds.
+CHAT_NOTIFICATIONS = {
+    'DIGEST_WINDOW': 5,
+}
+
+# Message side effects go through the transactional outbox. drain_outbox
+# runs DRAIN_DELAY seconds after a commit and handles up to MAX_BATCHES
+# batches of BATCH_SIZE events; a claim is leased for LEASE_SECONDS.
+CHAT_OUTBOX = {
+    'BATCH_SIZE': 500,
+    'MAX_BATCHES': 20,
+    'LEASE_SECONDS': 60,
+    'DRAIN_DELAY': 1,
+    # Failed events retry after RETRY_DELAY * 2 ** (attempts - 1) seconds
+    # and are dead-lettered (left unclaimed) after MAX_ATTEMPTS.
+    'MAX_ATTEMPTS': 10,
+    'RETRY_DELAY': 10,
+}
+
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
@@ -245,6 +344,14 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'chatapp.tasks.force_offline_stale_users',
         'schedule': 60.0, 
     },
+    'drain_outbox': {
+        'task': 'chatapp.tasks.drain_outbox',
+        'schedule': 10.0,
+    },
+    'flush_notification_digests': {
+        'task': 'chatapp.tasks.flush_notification_digests',
+        'schedule': 60.0,
+    },
 }
 
 
@@ -0,0 +1,49 @@
+import asyncio
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Under daphne, ASGI send() hands a frame to the Twisted transport and
+# returns at once, so a slow client only shows up as a growing transport
+# write buffer. WritePressure registers as a streaming producer on the
+# socket's protocol: Twisted pauses it when the buffer passes its high-water
+# mark and resumes it once drained, and the consumer's writer waits on it.
+@implementer(IPushProducer)
+class WritePressure:
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):
+        self.writable.set()
+
+    async def wait(self):
+        await self.writable.wait()
+
+
+# daphne's send is partial(server.handle_reply, protocol). Servers that await
+# the transport drain inside send() (uvicorn, hypercorn) already block the
+# writer, so there is nothing to attach and this returns None.
+def attach_write_pressure(send):
+    protocol = next(
+        (arg for arg in getattr(send, "args", ()) if hasattr(arg, "registerProducer")),
+        None
+    )
+    if protocol is None:
+        return None
+    pressure = WritePressure()
+    try:
+        protocol.registerProducer(pressure, True)
+    except Exception as e:
+        logger.warning(f"Could not watch the transport write buffer: {e}")
+        return None
+    return pressure
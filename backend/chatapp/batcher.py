@@ -0,0 +1,168 @@
+import asyncio
+import weakref
+from collections import deque
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from .db import db_sync_to_async
+from .models import Message
+from .services import save_messages
+import logging
+
+logger = logging.getLogger(__name__)
+
+_batchers = weakref.WeakKeyDictionary()
+
+
+def write_behind_config():
+    return getattr(settings, "CHAT_WRITE_BEHIND", {})
+
+
+def write_behind_enabled():
+    return write_behind_config().get("ENABLED", False)
+
+
+def get_message_batcher():
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        config = write_behind_config()
+        batcher = MessageBatcher(
+            max_batch=config.get("MAX_BATCH", 100),
+            max_delay=config.get("MAX_DELAY_MS", 5) / 1000,
+            durability=config.get("DURABILITY", "commit"),
+            id_block_size=config.get("ID_BLOCK_SIZE", 100),
+        )
+        _batchers[loop] = batcher
+    return batcher
+
+
+# Ids come from the table's own sequence, the one plain INSERTs draw from,
+# so reserved ids never collide with rows written outside the batcher and
+# there is no separate counter to lose or reseed. Ids a process reserved
+# but never used are skipped.
+def reserve_message_ids(count):
+    table = Message._meta.db_table
+    column = Message._meta.pk.column
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                [table, column, count]
+            )
+            return [row[0] for row in cursor.fetchall()]
+        if connection.vendor == "sqlite":
+            # AUTOINCREMENT keeps its high-water mark in sqlite_sequence. The
+            # UPDATE takes the write lock even when the table has no row there
+            # yet, so the INSERT below can't race another process.
+            cursor.execute("UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s", [count, table])
+            if not cursor.rowcount:
+                cursor.execute(
+                    f'INSERT INTO sqlite_sequence (name, seq) SELECT %s, COALESCE(MAX("{column}"), 0) + %s FROM "{table}"',
+                    [table, count]
+                )
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            high = cursor.fetchone()[0]
+            return list(range(high - count + 1, high + 1))
+    raise ImproperlyConfigured(f"Write-behind enqueue durability is not supported on {connection.vendor}")
+
+
+class MessageIdAllocator:
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self.ids = deque()
+
+    async def allocate(self):
+        if not self.ids:
+            self.ids.extend(await self.reserve_block())
+        return self.ids.popleft()
+
+    @db_sync_to_async
+    def reserve_block(self):
+        return reserve_message_ids(self.block_size)
+
+
+class MessageBatcher:
+    def __init__(self, max_batch=100, max_delay=0.005, durability="commit", id_block_size=100):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.durability = durability
+        self.ids = MessageIdAllocator(id_block_size)
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.callbacks = set()
+
+    # In "enqueue" mode the caller broadcasts before the row is written, so
+    # the id has to come from the allocator instead of the INSERT, and a
+    # failed write is reported through ``on_failure(message, error)``
+    # because nobody is awaiting it.
+    async def submit(self, message, on_failure=None):
+        if self.durability == "enqueue":
+            if message.mid is None:
+                message.mid = await self.ids.allocate()
+            future = None
+        else:
+            future = asyncio.get_running_loop().create_future()
+
+        self.pending.append((message, future, on_failure))
+        self.wakeup.set()
+        self.ensure_worker()
+
+        if future is None:
+            return message
+        return await future
+
+    def ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if len(self.pending) < self.max_batch:
+                await asyncio.sleep(self.max_delay)
+
+            batch = self.pending[:self.max_batch]
+            self.pending = self.pending[self.max_batch:]
+            if not self.pending:
+                self.wakeup.clear()
+
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        messages = [message for message, _, _ in batch]
+        try:
+            await self.write(messages)
+        except Exception as e:
+            if len(batch) > 1:
+                # One bad row rolls back the whole batch. Write the messages
+                # one by one so only that row's sender sees the failure.
+                logger.warning(f"Batch of {len(messages)} messages failed, writing them one by one: {e}")
+                for entry in batch:
+                    await self.flush([entry])
+                return
+            logger.error(f"Error writing message: {e}", exc_info=True)
+            message, future, on_failure = batch[0]
+            if future is None:
+                if on_failure is not None:
+                    self.spawn(on_failure(message, e))
+            elif not future.done():
+                future.set_exception(e)
+            return
+
+        for message, future, _ in batch:
+            if future is not None and not future.done():
+                future.set_result(message)
+        logger.debug(f"Committed batch of {len(messages)} messages")
+
+    # Failure callbacks run as their own tasks so a slow socket doesn't hold
+    # up the next batch.
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.callbacks.add(task)
+        task.add_done_callback(self.callbacks.discard)
+
+    @db_sync_to_async
+    def write(self, messages):
+        save_messages(messages)
@@ -0,0 +1,135 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+    binary = False
+
+    def encode(self, frame):
+        return json.dumps(frame)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    binary = False
+
+    def encode(self, frame):
+        return orjson.dumps(frame).decode()
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    binary = True
+
+    def encode(self, frame):
+        return msgpack.packb(frame, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+V2_JSON = "chat.v2.json"
+V2_MSGPACK = "chat.v2.msgpack"
+
+
+def available_subprotocols():
+    protocols = {V2_JSON: OrjsonCodec if orjson else JSONCodec}
+    if msgpack:
+        protocols[V2_MSGPACK] = MsgpackCodec
+    return protocols
+
+
+# Returns (subprotocol, codec). v1 is plain JSON with no subprotocol, so
+# clients that don't ask for v2 keep getting the frames they always did.
+def negotiate(requested):
+    protocols = available_subprotocols()
+    for subprotocol in requested or []:
+        if subprotocol in protocols:
+            return subprotocol, protocols[subprotocol]()
+    return None, JSONCodec()
+
+
+V2_KEYS = {
+    "type": "t",
+    "message": "m",
+    "message_id": "mid",
+    "seq": "sq",
+    "message_type": "mt",
+    "sender": "s",
+    "timestamp": "ts",
+    "is_read": "r",
+    "status": "st",
+    "recipient_online": "ro",
+    "recipient_id": "rid",
+    "new_status": "ns",
+    "image": "img",
+    "text": "tx",
+    "user_id": "u",
+    "is_typing": "ty",
+    "is_staff": "sf",
+    "last_read_seq": "lr",
+    "version": "v",
+    "users": "us",
+    "joined": "j",
+    "left": "l",
+    "messages": "ms",
+    "has_more": "hm",
+    "cursor": "c",
+    "chunk": "ck",
+    "chunks": "cks",
+    "name": "n",
+    "email": "e",
+    "conversation_id": "cv",
+    "code": "cd",
+}
+V2_KEYS_REVERSED = {short: key for key, short in V2_KEYS.items()}
+
+# Sender details travel once per session in "directory" frames instead.
+V2_DROPPED_KEYS = {"sender_name", "sender_email"}
+
+
+def compact(value):
+    if isinstance(value, dict):
+        return {
+            V2_KEYS.get(key, key): compact(item)
+            for key, item in value.items()
+            if key not in V2_DROPPED_KEYS
+        }
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    return value
+
+
+def expand(value):
+    if isinstance(value, dict):
+        return {V2_KEYS_REVERSED.get(key, key): expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    return value
+
+
+# Only the identity fields a frame actually carries: typing frames have a
+# name but no email, and must not pass off "" as the sender's email.
+def directory_entries(frame):
+    entries = {}
+    for item in [frame, *frame.get("messages", [])]:
+        user_id = item.get("sender") or item.get("user_id")
+        if user_id and "sender_name" in item:
+            entry = entries.setdefault(str(user_id), {"id": str(user_id)})
+            entry["name"] = item["sender_name"]
+            if "sender_email" in item:
+                entry["email"] = item["sender_email"]
+    return list(entries.values())
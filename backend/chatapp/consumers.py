@@ -1,234 +1,164 @@
 import json
+import uuid
+from urllib.parse import parse_qs
 import asyncio
+from collections import Counter, deque
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from asgiref.sync import sync_to_async
-from django.core.cache import cache
-from django.utils import timezone
+from django.conf import settings
 from users.models import CustomUser
-from .models import Conversation, Message, Notification
+from .models import Message, Notification
+from .context import ConversationContext, display_name, get_user_cards, load_conversation
+from .backpressure import attach_write_pressure
+from .batcher import get_message_batcher, write_behind_enabled
+from .db import db_sync_to_async
+from .presence import (
+    STATUS_CHANNEL, ConnectionCounter, get_online_ids, get_presence_snapshot, join_room,
+    leave_room, online_set_name
+)
+from .pubsub import get_pubsub_hub
+from .ratelimit import check_rate_limit
+from .codec import JSONCodec, compact, directory_entries, expand, negotiate
+from . import metrics
+from .services import has_unread, mark_conversation_read, resume_state, save_messages, unread_messages
 import logging
-from .tasks import notify_recipent_message
 logger = logging.getLogger(__name__)
 
-try:
-    redis_instance = cache.client.get_client(write=True)
-except Exception as e:
-    logger.error(f"Redis connection error: {e}")
-    redis_instance = None
-
-
-class ConnectionCounter:
-    TTL = 30
-    
-    def __init__(self, user_id, is_staff=False):
-        self.user_id = str(user_id)
-        self.key = f"user:{self.user_id}:connections"
-        self.heartbeat_key = f"user:{self.user_id}:last_heartbeat"
-        self.online_set = "online_staff" if is_staff else "online_users"
-        self.is_staff = is_staff
-
-    @sync_to_async
-    def increment(self):
-        try:
-            count = cache.get(self.key, 0) + 1
-            cache.set(self.key, count, timeout=self.TTL)
-            cache.set(f"user:{self.user_id}:status", "online", timeout=self.TTL)
-            cache.set(self.heartbeat_key, timezone.now().timestamp(), timeout=self.TTL)
-            
-            if redis_instance:
-                redis_instance.sadd(self.online_set, self.user_id)
-                redis_instance.publish("user_status_channel", json.dumps({
-                    "user_id": self.user_id,
-                    "status": "online",
-                    "is_staff": self.is_staff
-                }))
-            
-            return count
-        except Exception as e:
-            logger.error(f"Error incrementing connection count: {e}")
-            return 1
-
-    @sync_to_async
-    def decrement(self):
-        try:
-            count = cache.get(self.key, 0)
-            if count <= 1:
-                cache.delete(self.key)
-                cache.delete(self.heartbeat_key)
-                cache.set(f"user:{self.user_id}:status", "offline", timeout=60)
-                
-                if redis_instance:
-                    redis_instance.srem(self.online_set, self.user_id)
-                    redis_instance.publish("user_status_channel", json.dumps({
-                        "user_id": self.user_id,
-                        "status": "offline",
-                        "is_staff": self.is_staff
-                    }))
-                return 0
-            else:
-                count -= 1
-                cache.set(self.key, count, timeout=self.TTL)
-                return count
-        except Exception as e:
-            logger.error(f"Error decrementing connection count: {e}")
-            return 0
-
-    @sync_to_async
-    def get_count(self):
-        try:
-            return cache.get(self.key, 0)
-        except Exception as e:
-            logger.error(f"Error getting connection count: {e}")
-            return 0
-
-    @sync_to_async
-    def heartbeat(self):
-        try:
-            count = cache.get(self.key)
-            if count:
-                cache.set(self.key, count, timeout=self.TTL)
-                cache.set(f"user:{self.user_id}:status", "online", timeout=self.TTL)
-                cache.set(self.heartbeat_key, timezone.now().timestamp(), timeout=self.TTL)
-                logger.debug(f"Heartbeat updated for user {self.user_id}")
-        except Exception as e:
-            logger.error(f"Error updating heartbeat: {e}")
-
-    async def is_online(self):
-        count = await self.get_count()
-        return count > 0
-
-
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        try:
-            self.user = self.scope.get("user")
-            if not self.user or not self.user.is_authenticated:
-                logger.warning("Unauthenticated connection attempt")
-                await self.close(code=4001)
-                return
-
-            self.cid = self.scope["url_route"]["kwargs"].get("conversation_id")
-            if not self.cid:
-                logger.warning(f"No conversation_id provided for user {self.user.id}")
-                await self.close(code=4002)
-                return
-
-            self.conversation = await self.get_conversation_by_id(self.cid)
-            if not self.conversation:
-                logger.warning(f"Conversation {self.cid} not found")
-                await self.close(code=4004)
-                return
-
-            has_access = await self.has_access()
-            if not has_access:
-                logger.warning(f"User {self.user.id} denied access to conversation {self.cid}")
-                await self.close(code=4003)
-                return
-
-            self.room_name = f"conversation_{self.conversation.cid}"
-            await self.channel_layer.group_add(self.room_name, self.channel_name)
-            await self.accept()
-
-            self.counter = ConnectionCounter(self.user.id, self.user.is_staff)
-            count = await self.counter.increment()
-
-            if count == 1:
-                await self.channel_layer.group_send(
-                    self.room_name,
-                    {
-                        "type": "user_status_update",
-                        "user_id": str(self.user.id),
-                        "status": "online",
-                        "is_staff": self.user.is_staff
-                    }
-                )
-
-            await self.send_online_list()
-            await self.send_unread_messages()
-
-            logger.info(f"User {self.user.id} ({'staff' if self.user.is_staff else 'user'}) connected to conversation {self.cid}")
-
-        except Exception as e:
-            logger.error(f"Error in connect: {e}", exc_info=True)
-            await self.close(code=4500)
-
-    async def disconnect(self, close_code):
-        try:
-            if hasattr(self, "counter") and self.counter:
-                count = await self.counter.decrement()
-                if count == 0:
-                    if hasattr(self, "room_name"):
-                        await self.channel_layer.group_send(
-                            self.room_name,
-                            {
-                                "type": "user_status_update",
-                                "user_id": str(self.user.id),
-                                "status": "offline",
-                                "is_staff": self.user.is_staff
-                            }
-                        )
-
-            if hasattr(self, "room_name") and self.room_name:
-                await self.channel_layer.group_discard(self.room_name, self.channel_name)
-
-            logger.info(f"User {self.user.id if hasattr(self, 'user') else 'Unknown'} disconnected with code {close_code}")
-
-        except Exception as e:
-            logger.error(f"Error in disconnect: {e}", exc_info=True)
-
-    async def receive(self, text_data):
-        if not text_data:
-            return
+EPHEMERAL_EVENTS = {"typing_indicator", "user_status_update", "status_upgrade_handler"}
+SESSION_FRAMES = {"chat_message", "image", "read", "typing"}
+
+# Outbound frames that may be dropped when a socket's send queue is full,
+# and frames where a newer one for the same key supersedes a queued one.
+DROPPABLE_FRAMES = {"typing", "user_status", "status_upgrade", "presence_delta", "online_users"}
+COALESCED_FRAMES = {"typing", "user_status", "read", "online_users", "presence_snapshot"}
+
+
+def parse_seq(value):
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seq if seq >= 0 else None
+
+
+def normalize_cid(value):
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+# Presence transitions reach every subscribed socket in the process; the hub
+# runs this once per event so the joined user's card is looked up once.
+async def with_presence_card(event):
+    if event.get("status") != "online":
+        return event
+    cards = await db_sync_to_async(get_user_cards)([str(event["user_id"])])
+    return {**event, "card": cards[0] if cards else None}
+
+
+# Everything scoped to one conversation on a socket: its context, room and
+# context group membership, typing state and the room event handlers. A
+# ChatConsumer holds one session per conversation it is subscribed to.
+class ConversationSession:
+    typing_state = False
+    typing_wanted = False
+    typing_sent_at = 0.0
+    typing_flush = None
+    typing_expiry = None
+    # Set by open(): this socket is the user's first in the room.
+    first_join = False
+
+    def __init__(self, consumer, conversation):
+        self.consumer = consumer
+        self.conversation = conversation
+        self.cid = str(conversation.cid)
+        self.room_name = f"conversation_{self.cid}"
+        self.context = None
+        self.unread_count = getattr(conversation, conversation.unread_field_for(consumer.user))
+
+    @property
+    def user(self):
+        return self.consumer.user
+
+    # With track_presence=False the caller adds the room presence itself, e.g. in
+    # the same pipeline as the connection count.
+    async def open(self, track_presence=True):
+        if self.user.is_staff or hasattr(self.conversation, "first_staff_id"):
+            self.context = ConversationContext.resolve(self.user, self.conversation)
+        else:
+            self.context = await self.resolve_context()
+        steps = [
+            self.consumer.add_group(self.room_name),
+            *(self.consumer.add_group(group) for group in self.context.groups),
+            get_pubsub_hub().subscribe(self.ephemeral_channel, self.ephemeral_event)
+        ]
+        if track_presence:
+            steps.append(join_room(self.cid, self.user.id))
+        results = await asyncio.gather(*steps)
+        if track_presence:
+            self.first_join = results[-1] == 1
+
+    async def close(self, offline=False):
+        await self.stop_typing()
+        if offline:
+            await self.announce_status("offline")
+        await get_pubsub_hub().unsubscribe(self.ephemeral_channel, self.ephemeral_event)
+        await leave_room(self.cid, self.user.id)
+        await self.consumer.discard_group(self.room_name)
+        for group in self.context.groups:
+            await self.consumer.discard_group(group)
+
+    async def announce_status(self, status):
+        await self.send_ephemeral(
+            {
+                "type": "user_status_update",
+                "user_id": str(self.user.id),
+                "status": status,
+                "is_staff": self.user.is_staff
+            }
+        )
 
-        try:
-            data = json.loads(text_data)
-            msg_type = data.get("type")
-            logger.info(f"Received message from user {self.user.id}: type={msg_type}")
-            if msg_type == "chat_message":
-                unread = await self.get_unread_messages()
-                if unread:
-                    await self.handle_read_receipt(data)
-                await self.handle_chat_message(data)
-            elif msg_type == "image":
-                unread = await self.get_unread_messages()
-                if unread:
-                    await self.handle_read_receipt(data)
-                await self.handle_image(data)
-            elif msg_type == "read":
+    async def handle(self, msg_type, data):
+        if msg_type == "chat_message":
+            if await self.has_unread():
                 await self.handle_read_receipt(data)
-            elif msg_type == "typing":
-                await self.handle_typing(data)
-            elif msg_type == "heartbeat":
-                await self.counter.heartbeat()
-                await self.send_online_list()
-            else:
-                logger.warning(f"Unknown message type: {msg_type}")
+            await self.handle_chat_message(data)
+        elif msg_type == "image":
+            if await self.has_unread():
+                await self.handle_read_receipt(data)
+            await self.handle_image(data)
+        elif msg_type == "read":
+            await self.handle_read_receipt(data)
+        elif msg_type == "typing":
+            await self.handle_typing(data)
+
+    async def group_send(self, event):
+        # Room events carry the conversation id so a multiplexed socket can
+        # route them to the right session.
+        await self.consumer.channel_layer.group_send(self.room_name, {
+            **event,
+            "conversation_id": self.cid
+        })
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON received: {e}")
-        except Exception as e:
-            logger.error(f"Error in receive: {e}", exc_info=True)
-    
     async def handle_chat_message(self, data):
         text = data.get("text", "").strip()
         if not text:
             logger.warning("Empty message text received")
             return
 
-        try:            
+        try:
             message = await self.save_message(text)
             logger.info(f"Message saved with ID: {message.mid}")
-            
-            recipient_id = await self.get_recipient_id()
+
             recipient_online = await self.is_recipient_online()
 
-            sender_details = await self.get_sender_details()
+            sender_details = self.context.sender_details()
             initial_status = "delivered" if recipient_online else "sent"
 
             payload = {
                 "message": message.message,
                 "message_id": message.mid,
+                "seq": message.seq,
                 "sender": str(self.user.id),
                 "sender_name": sender_details["name"],
                 "sender_email": sender_details["email"],
@@ -237,63 +167,102 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 "status": initial_status,
                 "recipient_online": recipient_online
             }
-            
-            await self.channel_layer.group_send(self.room_name, {
+
+            await self.group_send({
                 "type": "chat_message_handler",
                 **payload
             })
-            notify_recipent_message.delay(message.message,sender_details['name'], recipient_id, type='message')
+            await self.stop_typing()
             logger.info(f"Message broadcasted successfully by user {self.user.id} with status {initial_status}")
 
         except Exception as e:
             logger.error(f"Error handling chat message: {e}", exc_info=True)
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "error",
                 "message": "Failed to send message"
-            }))
-    
+            })
+
     async def handle_read_receipt(self, data):
         try:
             logger.info(f"Handling read receipt from user {self.user.id}")
-            updated_count = await self.mark_messages_as_read(self.user.id)
-            
-            if updated_count > 0:
-                await self.channel_layer.group_send(
-                    self.room_name,
+            last_read_seq = await self.mark_messages_as_read(self.user.id)
+
+            if last_read_seq:
+                await self.group_send(
                     {
                         "type": "read_receipt_handler",
-                        "user_id": str(self.user.id)
+                        "user_id": str(self.user.id),
+                        "last_read_seq": last_read_seq
                     }
                 )
-                logger.debug(f"Read receipt sent by user {self.user.id} for {updated_count} messages")
+                logger.debug(f"Read receipt sent by user {self.user.id} up to seq {last_read_seq}")
         except Exception as e:
             logger.error(f"Error handling read receipt: {e}", exc_info=True)
 
-    
+
     async def handle_typing(self, data):
         try:
-            is_typing = data.get("is_typing", False)
-            sender_details = await self.get_sender_details()
-            
+            is_typing = bool(data.get("is_typing", False))
             logger.debug(f"Handling typing indicator from user {self.user.id}: {is_typing}")
-            
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    "type": "typing_indicator",
-                    "user_id": str(self.user.id),
-                    "sender_name": sender_details["name"],
-                    "is_typing": is_typing
-                }
-            )
-            logger.debug(f"Typing indicator broadcasted for user {self.user.id}")
+
+            self.cancel_typing_task("typing_expiry")
+            if is_typing:
+                self.typing_expiry = asyncio.create_task(self.expire_typing())
+            self.typing_wanted = is_typing
+
+            # Repeated frames for the current state collapse into nothing, and
+            # state changes inside MIN_INTERVAL are deferred and coalesced.
+            if is_typing == self.typing_state or self.typing_flush:
+                return
+            wait = self.typing_sent_at + settings.CHAT_TYPING["MIN_INTERVAL"] - asyncio.get_running_loop().time()
+            if wait > 0:
+                self.typing_flush = asyncio.create_task(self.flush_typing(wait))
+                return
+            await self.broadcast_typing(is_typing)
         except Exception as e:
             logger.error(f"Error handling typing indicator: {e}", exc_info=True)
-    
+
+    async def flush_typing(self, delay):
+        await asyncio.sleep(delay)
+        self.typing_flush = None
+        if self.typing_wanted != self.typing_state:
+            await self.broadcast_typing(self.typing_wanted)
+
+    async def expire_typing(self):
+        await asyncio.sleep(settings.CHAT_TYPING["EXPIRE"])
+        self.typing_expiry = None
+        await self.stop_typing()
+
+    async def stop_typing(self):
+        self.cancel_typing_task("typing_expiry")
+        self.cancel_typing_task("typing_flush")
+        self.typing_wanted = False
+        if self.typing_state:
+            await self.broadcast_typing(False)
+
+    def cancel_typing_task(self, name):
+        task = getattr(self, name)
+        if task and task is not asyncio.current_task():
+            task.cancel()
+        setattr(self, name, None)
+
+    async def broadcast_typing(self, is_typing):
+        self.typing_state = is_typing
+        self.typing_sent_at = asyncio.get_running_loop().time()
+        await self.send_ephemeral(
+            {
+                "type": "typing_indicator",
+                "user_id": str(self.user.id),
+                "sender_name": self.context.sender_name,
+                "is_typing": is_typing
+            }
+        )
+        logger.debug(f"Typing indicator broadcasted for user {self.user.id}")
+
     async def handle_image(self, data):
         image_url = data.get("image", "").strip()
         caption = data.get("text", "").strip()
-        
+
         if not image_url:
             logger.warning("Empty image URL received")
             return
@@ -304,13 +273,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
             recipient_online = await self.is_recipient_online()
 
-            sender_details = await self.get_sender_details()
+            sender_details = self.context.sender_details()
             initial_status = "delivered" if recipient_online else "sent"
 
             payload = {
                 "message": message.message or "",
-                "image": image_url, 
+                "image": image_url,
                 "message_id": message.mid,
+                "seq": message.seq,
                 "sender": str(self.user.id),
                 "sender_name": sender_details["name"],
                 "sender_email": sender_details["email"],
@@ -319,26 +289,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 "status": initial_status,
                 "recipient_online": recipient_online
             }
-            await self.channel_layer.group_send(self.room_name, {
+            await self.group_send({
                 "type": "image_message_handler",
                 **payload
             })
 
         except Exception as e:
             logger.error(f"Error handling image message: {e}", exc_info=True)
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "error",
                 "message": "Failed to send image"
-            }))
+            })
 
     async def image_message_handler(self, event):
         logger.debug(f"image_message_handler called for user {self.user.id}")
-        recipient_id = await self.get_recipient_id()
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             "type": "image_message",
             "message": event.get("message", ""),
-            "image": event["image"], 
+            "image": event["image"],
             "message_id": event["message_id"],
+            "seq": event.get("seq"),
             "sender": event["sender"],
             "sender_name": event.get("sender_name", ""),
             "sender_email": event.get("sender_email", ""),
@@ -346,31 +316,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
             "is_read": event.get("is_read", False),
             "status": event.get("status", "sent"),
             "recipient_online": event.get("recipient_online")
-        }))
-        notify_recipent_message.delay(
-            message=None,
-            sender=event.get("sender_name", ""),
-            recipient=recipient_id,
-            type='image'
-        )
+        })
 
-    @database_sync_to_async
-    def save_image_message(self, image_url, caption=None):
-        return Message.objects.create(
+    async def save_image_message(self, image_url, caption=None):
+        return await self.persist_message(Message(
             conversation=self.conversation,
             sender=self.user,
             image=image_url,
             message=caption or "",
             message_type="IMAGE",
             is_read=False
-        )
+        ))
 
     async def chat_message_handler(self, event):
         logger.debug(f"chat_message_handler called for user {self.user.id}: {event}")
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             "type": "chat_message",
             "message": event["message"],
             "message_id": event["message_id"],
+            "seq": event.get("seq"),
             "sender": event["sender"],
             "sender_name": event.get("sender_name", ""),
             "sender_email": event.get("sender_email", ""),
@@ -378,195 +342,206 @@ class ChatConsumer(AsyncWebsocketConsumer):
             "is_read": event.get("is_read", False),
             "status": event.get("status", "sent"),
             "recipient_online": event.get("recipient_online")
-        }))
+        })
         logger.debug(f"Message sent to client for user {self.user.id}")
 
     async def read_receipt_handler(self, event):
         user_id = event.get("user_id")
         if user_id != str(self.user.id):
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "read",
-                "user_id": user_id
-            }))
-  
+                "user_id": user_id,
+                "last_read_seq": event.get("last_read_seq")
+            })
+
     async def typing_indicator(self, event):
         user_id = event.get("user_id")
         if user_id != str(self.user.id):
             logger.debug(f"Sending typing indicator to user {self.user.id}: {event}")
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "typing",
                 "user_id": user_id,
                 "sender_name": event.get("sender_name", ""),
                 "is_typing": event.get("is_typing", False)
-            }))
+            })
 
     async def user_status_update(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             "type": "user_status",
             "user_id": event["user_id"],
             "status": event["status"],
             "is_staff": event.get("is_staff", False)
-        }))
+        })
         if event["status"] == "online":
             await self.upgrade_message_status(event["user_id"])
 
-    async def send_online_list(self):
+    # A client that knows the last seq it saw resumes from there; everyone
+    # else gets the unread replay.
+    async def send_backlog(self, since=None):
+        if since is None:
+            # The unread counter came with the conversation row, so the
+            # common case of nothing unread costs no query.
+            if self.unread_count:
+                await self.send_unread_messages()
+        else:
+            await self.send_resume(since)
+
+    async def send_unread_messages(self):
         try:
-            if not redis_instance:
-                users = []
-            else:
-                if self.user.is_staff:
-                    candidate_ids = await sync_to_async(redis_instance.smembers)("online_users")
-                else:
-                    candidate_ids = await sync_to_async(redis_instance.smembers)("online_staff")
-
-                online_ids = []
-
-                for raw_id in candidate_ids:
-                    user_id = raw_id.decode() if isinstance(raw_id, bytes) else str(raw_id)
-                    exists = await sync_to_async(cache.get)(f"user:{user_id}:connections")
-                    if exists:
-                        online_ids.append(user_id)
-                    else:
-                        await sync_to_async(redis_instance.srem)(
-                            "online_users" if self.user.is_staff else "online_staff",
-                            user_id
-                        )
-
-                users = await self.get_users_by_ids(online_ids)
-
-            await self.send(text_data=json.dumps({
-                "type": "online_users",
-                "users": [
-                    {
-                        "id": str(u.id),
-                        "name": f"{u.first_name} {u.last_name}".strip() or u.email,
-                        "email": u.email,
-                        "is_staff": u.is_staff
-                    }
-                    for u in users
-                ]
-            }))
+            limit = settings.CHAT_UNREAD_REPLAY["LIMIT"]
 
+            unread_messages = await self.get_unread_messages(limit=limit + 1)
+            has_more = len(unread_messages) > limit
+            unread_messages = unread_messages[:limit]
+            if not unread_messages:
+                return
+            await self.send_batches("unread_batch", unread_messages, has_more, cursor=lambda msg: msg.seq)
         except Exception as e:
-            logger.error(f"Error sending online list: {e}", exc_info=True)
+            logger.error(f"Error sending unread messages: {e}", exc_info=True)
 
-    async def send_unread_messages(self):
+    # Replays every message after ``since`` in one range query, then the
+    # current read watermarks and recipient presence, which supersede any
+    # read or status frames missed while disconnected.
+    async def send_resume(self, since):
         try:
-            unread_messages = await self.get_unread_messages()
-            for msg in unread_messages:
-                sender_info = await self.get_user_info(msg.sender_id)
-                
-                message_data = {
-                    "type": "chat_message" if msg.message_type != "IMAGE" else "image_message",
-                    "message": msg.message,
-                    "message_id": msg.mid,
-                    "sender": str(msg.sender_id),
-                    "sender_name": sender_info["name"],
-                    "sender_email": sender_info["email"],
-                    "timestamp": msg.timestamp.isoformat(),
-                    "is_read": False,
-                    "status": "delivered",
-                    "unread": True
-                }
-                
-                if msg.message_type == "IMAGE":
-                    message_data["image"] = msg.image
-                
-                await self.send(text_data=json.dumps(message_data))
+            limit = settings.CHAT_UNREAD_REPLAY["LIMIT"]
+
+            messages, watermarks, last_seq = await self.get_resume_state(since, limit=limit + 1)
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            if messages:
+                await self.send_batches("resume_batch", messages, has_more, cursor=lambda msg: msg.seq)
+
+            await self.send_frame({
+                "type": "resume_complete",
+                "seq": messages[-1].seq if has_more else last_seq,
+                "has_more": has_more,
+                "watermarks": watermarks,
+                "recipient_online": await self.is_recipient_online()
+            })
         except Exception as e:
-            logger.error(f"Error sending unread messages: {e}", exc_info=True)
+            logger.error(f"Error resuming from seq {since}: {e}", exc_info=True)
+
+    async def send_batches(self, frame_type, messages, has_more, cursor):
+        chunk_size = settings.CHAT_UNREAD_REPLAY["CHUNK_SIZE"]
+        chunks = [
+            messages[i:i + chunk_size]
+            for i in range(0, len(messages), chunk_size)
+        ]
+        for index, chunk in enumerate(chunks):
+            frame = {
+                "type": frame_type,
+                "chunk": index + 1,
+                "chunks": len(chunks),
+                "messages": [self.serialize_unread(msg) for msg in chunk]
+            }
+            if index == len(chunks) - 1:
+                frame["has_more"] = has_more
+                frame["cursor"] = cursor(chunk[-1]) if has_more else None
+            await self.send_frame(frame)
+
+    def serialize_unread(self, msg):
+        message_data = {
+            "message": msg.message,
+            "message_id": msg.mid,
+            "seq": msg.seq,
+            "message_type": msg.message_type,
+            "sender": str(msg.sender_id),
+            "sender_name": display_name(msg.sender),
+            "sender_email": msg.sender.email,
+            "timestamp": msg.timestamp.isoformat(),
+            "is_read": False,
+            "status": "delivered"
+        }
+        if msg.message_type == "IMAGE":
+            message_data["image"] = msg.image
+        return message_data
 
+    # Notifications are not sent from here: save_messages records an outbox
+    # event in the same transaction and drain_outbox notifies recipients who
+    # don't have the conversation open.
     async def is_recipient_online(self):
-        recipient_id = await self.get_recipient_id()
+        recipient_id = self.context.recipient_id
+        if recipient_id is None:
+            return False
         counter = ConnectionCounter(recipient_id, not self.user.is_staff)
-        online = await counter.is_online()
-        return online, recipient_id
-
-
-    @database_sync_to_async
-    def get_sender_details(self):
-        return {
-            "name": f"{self.user.first_name} {self.user.last_name}".strip() or self.user.email,
-            "email": self.user.email
-        }
-
-    @database_sync_to_async
-    def get_user_info(self, user_id):
-        try:
-            user = CustomUser.objects.get(id=user_id)
-            return {
-                "name": f"{user.first_name} {user.last_name}".strip() or user.email,
-                "email": user.email
-            }
-        except CustomUser.DoesNotExist:
-            return {"name": "Unknown User", "email": ""}
-
-    @database_sync_to_async
-    def get_users_by_ids(self, ids):
-        if not ids:
-            return []
-        return list(CustomUser.objects.filter(id__in=ids))
-
-    @database_sync_to_async
-    def get_unread_messages(self):
-        return list(
-            Message.objects.filter(
-                conversation=self.conversation,
-                is_read=False
-            )
-            .exclude(sender=self.user)
+        return await counter.is_online()
+
+    async def refresh_context(self):
+        old_groups = self.context.groups
+        self.context = await self.resolve_context()
+        new_groups = self.context.groups
+        for group in old_groups - new_groups:
+            await self.consumer.discard_group(group)
+        for group in new_groups - old_groups:
+            await self.consumer.add_group(group)
+        logger.debug(f"Conversation context refreshed for user {self.user.id} in {self.cid}")
+
+    @db_sync_to_async
+    def get_unread_messages(self, limit=None):
+        messages = (
+            unread_messages(self.conversation, self.user)
             .select_related('sender')
-            .order_by("timestamp")
+            .order_by("seq")
         )
+        if limit is not None:
+            messages = messages[:limit]
+        return list(messages)
 
-    @database_sync_to_async
-    def save_message(self, text):
-        message = Message.objects.create(
+    @db_sync_to_async
+    def get_resume_state(self, since, limit):
+        return resume_state(self.conversation, since, limit)
+
+    async def save_message(self, text):
+        message = await self.persist_message(Message(
             conversation=self.conversation,
             sender=self.user,
             message=text,
             is_read=False
-        )
+        ))
         logger.info(f"Message saved to database: ID={message.mid}, sender={self.user.id}, text='{text}'")
         return message
 
-    @database_sync_to_async
-    def get_recipient_id(self):
-        if self.user.is_staff:
-            return self.conversation.user.id
-        staff = CustomUser.objects.filter(is_staff=True).first()
-        return staff.id if staff else None
+    async def persist_message(self, message):
+        if write_behind_enabled():
+            return await get_message_batcher().submit(message, on_failure=self.report_unsaved)
+        return await self.insert_message(message)
+
+    # Write-behind enqueue mode broadcasts before the write; if the batch then
+    # fails the sender is told which message was lost.
+    async def report_unsaved(self, message, error):
+        await self.send_frame({
+            "type": "error",
+            "code": "message_not_saved",
+            "message_id": message.mid,
+            "message": "Failed to save message"
+        })
+
+    @db_sync_to_async
+    def insert_message(self, message):
+        save_messages([message])
+        return message
+
+    @db_sync_to_async
+    def resolve_context(self):
+        return ConversationContext.resolve(self.user, self.conversation)
 
-    @database_sync_to_async
+    @db_sync_to_async
+    def has_unread(self):
+        return has_unread(self.conversation, self.user)
+
+    @db_sync_to_async
     def mark_messages_as_read(self, user_id):
-        updated = Message.objects.filter(
-            conversation=self.conversation,
-            is_read=False
-        ).exclude(
-            sender_id=user_id
-        ).update(is_read=True)
-        logger.debug(f"Marked {updated} messages as read for user {user_id}")
-        return updated
+        last_read_seq = mark_conversation_read(self.conversation, self.user)
+        logger.debug(f"Read pointer for user {user_id} moved to {last_read_seq}")
+        return last_read_seq
 
-    @database_sync_to_async
-    def get_conversation_by_id(self, cid):
-        try:
-            return Conversation.objects.select_related('user').get(cid=cid)
-        except Conversation.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def has_access(self):
-        return self.user.is_staff or self.user == self.conversation.user
-    
     async def upgrade_message_status(self, online_user_id):
         try:
-            recipient_id = await self.get_recipient_id()
-            
+            recipient_id = self.context.recipient_id
+
             if str(online_user_id) == str(recipient_id):
-                await self.channel_layer.group_send(
-                    self.room_name,
+                await self.send_ephemeral(
                     {
                         "type": "status_upgrade_handler",
                         "recipient_id": str(online_user_id),
@@ -576,13 +551,478 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 logger.info(f"Upgraded message status to delivered for recipient {online_user_id}")
         except Exception as e:
             logger.error(f"Error upgrading message status: {e}", exc_info=True)
-    
+
+    async def send_frame(self, frame):
+        if self.consumer.multiplexed:
+            frame = {**frame, "conversation_id": self.cid}
+        await self.consumer.send_frame(frame, cid=self.cid)
+
+    @property
+    def ephemeral_channel(self):
+        return f"chat:ephemeral:{self.room_name}"
+
+    # Typing, presence and status upgrades are fire-and-forget: one PUBLISH
+    # on the room's pub/sub channel instead of the channel layer's durable,
+    # capacity-bound per-channel queues. Chat messages stay on group_send.
+    async def send_ephemeral(self, event):
+        try:
+            await get_pubsub_hub().publish(self.ephemeral_channel, event)
+        except Exception as e:
+            logger.error(f"Error publishing ephemeral event: {e}", exc_info=True)
+
+    async def ephemeral_event(self, event):
+        if event.get("type") in EPHEMERAL_EVENTS:
+            await getattr(self, event["type"])(event)
+
     async def status_upgrade_handler(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             "type": "status_upgrade",
             "recipient_id": event["recipient_id"],
             "new_status": event["new_status"]
-        }))
+        })
+
+
+# ws/chat/<conversation_id>/ binds the socket to one conversation, as before.
+# ws/chat/ is multiplexed: the socket authenticates and counts towards
+# presence once, then subscribes to conversations with in-band frames, and
+# every conversation-scoped frame carries its conversation_id.
+class ChatConsumer(AsyncWebsocketConsumer):
+    subprotocol = None
+    codec = JSONCodec()
+    multiplexed = False
+    counter = None
+    presence_subscribed = False
+    presence_version = 0
+    writer = None
+    write_pressure = None
+    overflowed = False
+    connect_started = None
+
+    async def connect(self):
+        try:
+            started = self.connect_started = asyncio.get_running_loop().time()
+            self.send_queue = deque()
+            self.send_ready = asyncio.Event()
+            self.delivered_seq = {}
+            self.user = self.scope.get("user")
+            if not self.user or not self.user.is_authenticated:
+                logger.warning("Unauthenticated connection attempt")
+                await self.close(code=4001)
+                return
+
+            self.sessions = {}
+            self.group_refs = Counter()
+            self.subprotocol, self.codec = negotiate(self.scope.get("subprotocols"))
+            self.known_users = {}
+
+            cid = self.scope["url_route"]["kwargs"].get("conversation_id")
+            self.multiplexed = cid is None
+            if not self.multiplexed:
+                conversation, close_code = await self.load_conversation(cid)
+                if close_code:
+                    await self.close(code=close_code)
+                    return
+                await self.open_session(conversation, track_presence=False)
+
+            await self.accept(subprotocol=self.subprotocol)
+            self.write_pressure = attach_write_pressure(self.base_send)
+
+            # Presence, the online list and the backlog don't depend on each
+            # other; their frames go through the send queue in any order.
+            self.counter = ConnectionCounter(self.user.id, self.user.is_staff)
+            since = parse_seq(parse_qs(self.scope.get("query_string", b"").decode()).get("since", [None])[0])
+            count, *_ = await asyncio.gather(
+                self.counter.increment(rooms=list(self.sessions)),
+                self.send_online_list(),
+                *(session.send_backlog(since) for session in self.sessions.values())
+            )
+
+            if count == 1:
+                await asyncio.gather(*(session.announce_status("online") for session in self.sessions.values()))
+
+            metrics.observe("ws.connect.handshake_ms", (asyncio.get_running_loop().time() - started) * 1000)
+
+            if self.multiplexed:
+                logger.info(f"User {self.user.id} ({'staff' if self.user.is_staff else 'user'}) connected to multiplexed chat")
+            else:
+                logger.info(f"User {self.user.id} ({'staff' if self.user.is_staff else 'user'}) connected to conversation {cid}")
+
+        except Exception as e:
+            logger.error(f"Error in connect: {e}", exc_info=True)
+            await self.close(code=4500)
+
+    async def disconnect(self, close_code):
+        try:
+            if self.writer:
+                self.writer.cancel()
+
+            if self.presence_subscribed:
+                await get_pubsub_hub().unsubscribe(STATUS_CHANNEL, self.presence_event)
+
+            count = None
+            if self.counter:
+                count = await self.counter.decrement()
+
+            for session in list(getattr(self, "sessions", {}).values()):
+                await session.close(offline=count == 0)
+            self.sessions = {}
+
+            logger.info(f"User {self.user.id if hasattr(self, 'user') else 'Unknown'} disconnected with code {close_code}")
+
+        except Exception as e:
+            logger.error(f"Error in disconnect: {e}", exc_info=True)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        raw = text_data if text_data is not None else bytes_data
+        if not raw:
+            return
+
+        try:
+            data = self.codec.decode(raw)
+            if self.subprotocol:
+                data = expand(data)
+            msg_type = data.get("type")
+            logger.info(f"Received message from user {self.user.id}: type={msg_type}")
+            if msg_type in settings.CHAT_RATE_LIMITS and not await self.allow(msg_type, data):
+                return
+            if msg_type in SESSION_FRAMES:
+                session = await self.session_for(data)
+                if session:
+                    await session.handle(msg_type, data)
+            elif msg_type == "subscribe" and self.multiplexed:
+                await self.subscribe(data.get("conversation_id"), parse_seq(data.get("since")))
+            elif msg_type == "unsubscribe" and self.multiplexed:
+                await self.unsubscribe(data.get("conversation_id"))
+            elif msg_type == "heartbeat":
+                await self.counter.heartbeat()
+                if not self.presence_subscribed:
+                    await self.send_online_list()
+            elif msg_type == "presence_subscribe":
+                await self.subscribe_presence()
+            elif msg_type == "presence_sync":
+                if data.get("version") != self.presence_version:
+                    await self.send_presence_snapshot()
+            else:
+                logger.warning(f"Unknown message type: {msg_type}")
+
+        except (ValueError, TypeError) as e:
+            logger.error(f"Invalid frame received: {e}")
+        except Exception as e:
+            logger.error(f"Error in receive: {e}", exc_info=True)
+
+    async def allow(self, msg_type, data):
+        allowed, retry_after = await check_rate_limit(self.user.id, msg_type)
+        if allowed:
+            return True
+        metrics.incr(f"ws.rate_limited.{msg_type}")
+        logger.warning(f"Rate limited {msg_type} from user {self.user.id}")
+        frame = {
+            "type": "error",
+            "code": "rate_limited",
+            "message": "Too many requests",
+            "event": msg_type,
+            "retry_after": retry_after
+        }
+        if self.multiplexed:
+            frame["conversation_id"] = data.get("conversation_id")
+        await self.send_frame(frame)
+        return False
+
+    async def session_for(self, data):
+        if not self.multiplexed:
+            return next(iter(self.sessions.values()), None)
+        cid = normalize_cid(data.get("conversation_id"))
+        session = self.sessions.get(cid)
+        if session is None:
+            await self.send_frame({
+                "type": "error",
+                "code": "not_subscribed",
+                "message": "Not subscribed to conversation",
+                "conversation_id": data.get("conversation_id")
+            })
+        return session
+
+    async def subscribe(self, conversation_id, since=None):
+        cid = normalize_cid(conversation_id)
+        if cid in self.sessions:
+            await self.send_frame({"type": "subscribed", "conversation_id": cid})
+            return
+        if len(self.sessions) >= settings.CHAT_MULTIPLEX["MAX_SUBSCRIPTIONS"]:
+            await self.send_frame({
+                "type": "error",
+                "code": "too_many_subscriptions",
+                "message": "Subscription limit reached",
+                "conversation_id": conversation_id
+            })
+            return
+
+        conversation, close_code = await self.load_conversation(cid)
+        if close_code:
+            await self.send_frame({
+                "type": "error",
+                "code": "forbidden" if close_code == 4003 else "not_found",
+                "message": "Access denied" if close_code == 4003 else "Conversation not found",
+                "conversation_id": conversation_id
+            })
+            return
+
+        session = await self.open_session(conversation)
+        # The room already saw the user come online through their other
+        # sockets; only the first join announces it.
+        if session.first_join:
+            await session.announce_status("online")
+        await self.send_frame({"type": "subscribed", "conversation_id": session.cid})
+        await session.send_backlog(since)
+        logger.info(f"User {self.user.id} subscribed to conversation {session.cid}")
+
+    async def unsubscribe(self, conversation_id):
+        cid = normalize_cid(conversation_id)
+        session = self.sessions.pop(cid, None)
+        if session:
+            await session.close()
+            logger.info(f"User {self.user.id} unsubscribed from conversation {cid}")
+        await self.send_frame({"type": "unsubscribed", "conversation_id": cid or conversation_id})
+
+    async def load_conversation(self, cid):
+        conversation = await self.get_conversation_by_id(cid) if cid else None
+        if not conversation:
+            logger.warning(f"Conversation {cid} not found")
+            return None, 4004
+
+        if not (self.user.is_staff or conversation.user_id == self.user.id):
+            logger.warning(f"User {self.user.id} denied access to conversation {cid}")
+            return None, 4003
+        return conversation, None
+
+    async def open_session(self, conversation, track_presence=True):
+        session = ConversationSession(self, conversation)
+        await session.open(track_presence=track_presence)
+        self.sessions[session.cid] = session
+        return session
+
+    # Sessions share the user's context group (and a recipient's, when two
+    # conversations have the same staff counterpart), so membership is
+    # reference counted per socket.
+    async def add_group(self, group):
+        self.group_refs[group] += 1
+        if self.group_refs[group] == 1:
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def discard_group(self, group):
+        self.group_refs[group] -= 1
+        if self.group_refs[group] <= 0:
+            del self.group_refs[group]
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def route_event(self, event):
+        session = self.sessions.get(event.get("conversation_id"))
+        if session:
+            await getattr(session, event["type"])(event)
+
+    async def chat_message_handler(self, event):
+        await self.route_event(event)
+
+    async def image_message_handler(self, event):
+        await self.route_event(event)
+
+    async def read_receipt_handler(self, event):
+        await self.route_event(event)
+
+    async def send_online_list(self):
+        try:
+            online_ids = await get_online_ids(online_set_name(not self.user.is_staff))
+            users = await self.get_user_cards(online_ids)
+
+            await self.send_frame({
+                "type": "online_users",
+                "users": users
+            })
+
+        except Exception as e:
+            logger.error(f"Error sending online list: {e}", exc_info=True)
+
+    async def subscribe_presence(self):
+        if self.presence_subscribed:
+            await self.send_presence_snapshot()
+            return
+        self.presence_subscribed = True
+        await get_pubsub_hub().subscribe(STATUS_CHANNEL, self.presence_event, prepare=with_presence_card)
+        await self.send_presence_snapshot()
+
+    async def send_presence_snapshot(self):
+        try:
+            version, online_ids = await get_presence_snapshot(
+                online_set_name(not self.user.is_staff)
+            )
+            users = await self.get_user_cards(online_ids)
+            self.presence_version = version
+
+            await self.send_frame({
+                "type": "presence_snapshot",
+                "version": version,
+                "users": users
+            })
+        except Exception as e:
+            logger.error(f"Error sending presence snapshot: {e}", exc_info=True)
+
+    async def presence_event(self, event):
+        if bool(event.get("is_staff")) == self.user.is_staff:
+            return
+        version = event.get("version", 0)
+        if version <= self.presence_version:
+            return
+        if version != self.presence_version + 1:
+            logger.debug(f"Presence version gap for user {self.user.id}: {self.presence_version} -> {version}")
+            await self.send_presence_snapshot()
+            return
+
+        self.presence_version = version
+        user_id = str(event["user_id"])
+        delta = {
+            "type": "presence_delta",
+            "version": version,
+            "joined": [],
+            "left": []
+        }
+        if event.get("status") == "online":
+            card = event.get("card")
+            delta["joined"] = [card] if card else await self.get_user_cards([user_id])
+        else:
+            delta["left"] = [user_id]
+        await self.send_frame(delta)
+
+    async def context_invalidate(self, event):
+        user_id = event.get("user_id")
+        try:
+            if user_id == str(self.user.id):
+                self.user = await self.reload_user()
+            for session in list(self.sessions.values()):
+                if user_id in (str(self.user.id), str(session.context.recipient_id)):
+                    await session.refresh_context()
+            if self.subprotocol and user_id in self.known_users:
+                # v2 clients resolve senders from the directory they were
+                # sent once, so push the changed entry again.
+                entries = [
+                    {"id": card["id"], "name": card["name"], "email": card["email"]}
+                    for card in await self.get_user_cards([user_id])
+                ]
+                if entries:
+                    self.known_users[user_id] = entries[0]
+                    await self.send_encoded(compact({"type": "directory", "users": entries}))
+        except Exception as e:
+            logger.error(f"Error refreshing conversation context: {e}", exc_info=True)
+
+    @db_sync_to_async
+    def get_user_cards(self, ids):
+        return get_user_cards(ids)
+
+    @db_sync_to_async
+    def reload_user(self):
+        return CustomUser.objects.get(id=self.user.id)
+
+    @db_sync_to_async
+    def get_conversation_by_id(self, cid):
+        return load_conversation(cid)
+
+    # Frames go through a bounded per-socket queue drained by one writer task,
+    # which stalls while the client's transport buffer is full (see
+    # backpressure.py). When the queue is full, droppable frames (typing,
+    # presence) go first; if only messages are left the socket is closed with
+    # the last seq it received per conversation so the client can resume
+    # with ?since=.
+    async def send_frame(self, frame, cid=None):
+        if self.overflowed:
+            return
+        key = None
+        if frame["type"] in COALESCED_FRAMES:
+            key = (frame["type"], cid, frame.get("user_id"))
+            for queued in self.send_queue:
+                if queued[1] == key:
+                    self.send_queue.remove(queued)
+                    metrics.incr("ws.frames.coalesced")
+                    break
+
+        if len(self.send_queue) >= settings.CHAT_SEND_QUEUE["MAX_FRAMES"]:
+            if frame["type"] in DROPPABLE_FRAMES:
+                metrics.incr("ws.frames.dropped")
+                return
+            kept = deque(queued for queued in self.send_queue if queued[0]["type"] not in DROPPABLE_FRAMES)
+            metrics.incr("ws.frames.dropped", len(self.send_queue) - len(kept))
+            self.send_queue = kept
+            if len(self.send_queue) >= settings.CHAT_SEND_QUEUE["MAX_FRAMES"]:
+                await self.close_overflowed()
+                return
+
+        self.send_queue.append((frame, key, cid))
+        metrics.observe("ws.send_queue.depth", len(self.send_queue))
+        self.send_ready.set()
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self.run_writer())
+
+    async def run_writer(self):
+        while True:
+            await self.send_ready.wait()
+            while self.send_queue:
+                if self.write_pressure is not None:
+                    await self.write_pressure.wait()
+                    if not self.send_queue:
+                        break
+                frame, _, cid = self.send_queue.popleft()
+                try:
+                    await self.deliver(frame, cid)
+                except Exception as e:
+                    logger.error(f"Error sending frame to user {self.user.id}: {e}", exc_info=True)
+            self.send_ready.clear()
+
+    async def close_overflowed(self):
+        self.overflowed = True
+        if self.writer:
+            self.writer.cancel()
+        metrics.incr("ws.slow_consumer_closed")
+        logger.warning(f"Send queue overflow for user {self.user.id}, closing with resume hint")
+        self.send_queue.clear()
+        hint = {
+            "type": "resume_required",
+            "conversations": {cid: self.delivered_seq.get(cid) for cid in self.sessions}
+        }
+        if not self.multiplexed:
+            hint["seq"] = next(iter(hint["conversations"].values()), None)
+        await self.deliver(hint)
+        await self.close(code=4008)
+
+    async def deliver(self, frame, cid=None):
+        if self.connect_started is not None:
+            metrics.observe("ws.connect.first_frame_ms", (asyncio.get_running_loop().time() - self.connect_started) * 1000)
+            self.connect_started = None
+        if cid is not None:
+            messages = frame.get("messages")
+            seq = frame.get("seq") or (messages[-1].get("seq") if messages else None)
+            if seq and seq > self.delivered_seq.get(cid, 0):
+                self.delivered_seq[cid] = seq
+
+        if self.subprotocol:
+            # v2 references senders by id; names and emails go out once per
+            # session in a directory frame ahead of the first frame using them.
+            # known_users mirrors what the client holds, so a frame bringing a
+            # field it lacks (an email after a typing frame) updates the entry.
+            entries = []
+            for entry in directory_entries(frame):
+                known = self.known_users.get(entry["id"], {})
+                if any(known.get(key) != value for key, value in entry.items()):
+                    known = self.known_users[entry["id"]] = {**known, **entry}
+                    entries.append(known)
+            if entries:
+                await self.send_encoded(compact({"type": "directory", "users": entries}))
+            frame = compact(frame)
+        await self.send_encoded(frame)
+
+    async def send_encoded(self, frame):
+        payload = self.codec.encode(frame)
+        if self.codec.binary:
+            await self.send(bytes_data=payload)
+        else:
+            await self.send(text_data=payload)
+        metrics.incr("ws.frames.sent")
 
 
 class NotificationConsumer(AsyncWebsocketConsumer):
@@ -634,7 +1074,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             
 
 
-    @database_sync_to_async
+    @db_sync_to_async
     def mark_notification_read(self, notification_id):
         updated = Notification.objects.filter(
             nid=notification_id,
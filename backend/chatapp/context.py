@@ -0,0 +1,121 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.db.models import Subquery
+from users.models import CustomUser
+from .models import Conversation
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def display_name(user):
+    return f"{user.first_name} {user.last_name}".strip() or user.email
+
+
+USER_CARD_TTL = 60 * 60
+
+
+def user_card_key(user_id):
+    return f"user_card:{user_id}"
+
+
+def get_user_cards(user_ids):
+    if not user_ids:
+        return []
+    keys = {user_card_key(user_id): str(user_id) for user_id in user_ids}
+    cards = {keys[key]: card for key, card in cache.get_many(list(keys)).items()}
+
+    missing = [user_id for user_id in keys.values() if user_id not in cards]
+    if missing:
+        loaded = {}
+        for user in CustomUser.objects.filter(id__in=missing).only("id", "first_name", "last_name", "email", "is_staff"):
+            loaded[str(user.id)] = {
+                "id": str(user.id),
+                "name": display_name(user),
+                "email": user.email,
+                "is_staff": user.is_staff
+            }
+        if loaded:
+            cache.set_many({user_card_key(user_id): card for user_id, card in loaded.items()}, timeout=USER_CARD_TTL)
+        cards.update(loaded)
+
+    return [cards[user_id] for user_id in keys.values() if user_id in cards]
+
+
+def invalidate_user_card(user_id):
+    cache.delete(user_card_key(user_id))
+
+
+def context_group_name(user_id):
+    return f"chat_context_{user_id}"
+
+
+# Resolved once per connection so the send path never goes back to the DB.
+# Sockets join the context groups of both participants and rebuild the
+# context when either of them publishes a ``context_invalidate`` event.
+class ConversationContext:
+    def __init__(self, user, conversation, recipient_id):
+        self.cid = str(conversation.cid)
+        self.slug = conversation.slug
+        self.owner_id = conversation.user_id
+        self.room_name = f"conversation_{conversation.cid}"
+        self.user_id = user.id
+        self.is_staff = user.is_staff
+        self.sender_name = display_name(user)
+        self.sender_email = user.email
+        self.recipient_id = recipient_id
+
+    @classmethod
+    def resolve(cls, user, conversation):
+        if user.is_staff:
+            recipient_id = conversation.user_id
+        elif hasattr(conversation, "first_staff_id"):
+            recipient_id = conversation.first_staff_id
+        else:
+            recipient_id = (
+                CustomUser.objects.filter(is_staff=True)
+                .order_by("id")
+                .values_list("id", flat=True)
+                .first()
+            )
+        return cls(user, conversation, recipient_id)
+
+    @property
+    def groups(self):
+        groups = {context_group_name(self.user_id)}
+        if self.recipient_id is not None:
+            groups.add(context_group_name(self.recipient_id))
+        return groups
+
+    def sender_details(self):
+        return {"name": self.sender_name, "email": self.sender_email}
+
+
+# Everything a socket needs to join a conversation in one query: the row
+# (with its unread counters), the owner, and the staff recipient that
+# ConversationContext.resolve would otherwise look up separately.
+def load_conversation(cid):
+    first_staff = CustomUser.objects.filter(is_staff=True).order_by("id").values("id")[:1]
+    return (
+        Conversation.objects.select_related("user")
+        .annotate(first_staff_id=Subquery(first_staff))
+        .filter(cid=cid)
+        .first()
+    )
+
+
+def invalidate_user_context(user_id):
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(
+            context_group_name(user_id),
+            {
+                "type": "context_invalidate",
+                "user_id": str(user_id)
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error invalidating conversation context for user {user_id}: {e}")
@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from . import metrics
+
+# database_sync_to_async defaults to thread_sensitive=True, which runs every
+# consumer query in the process on one shared thread. db_sync_to_async runs
+# them on a bounded pool instead; each pool thread keeps its own connection
+# for CONN_MAX_AGE, and close_old_connections runs around every call.
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = 0
+
+
+def db_executor_config():
+    return getattr(settings, "CHAT_DB_EXECUTOR", {})
+
+
+def get_db_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=db_executor_config().get("MAX_WORKERS", 8),
+                thread_name_prefix="chat-db"
+            )
+    return _executor
+
+
+def track_in_flight(delta):
+    global _in_flight
+    with _executor_lock:
+        _in_flight += delta
+        in_flight = _in_flight
+    metrics.gauge("db.executor.in_flight", in_flight)
+    if delta > 0:
+        metrics.observe("db.executor.queue_depth", max(0, in_flight - db_executor_config().get("MAX_WORKERS", 8)))
+
+
+class ExecutorSyncToAsync(DatabaseSyncToAsync):
+    async def __call__(self, *args, **kwargs):
+        track_in_flight(1)
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            track_in_flight(-1)
+
+
+def db_sync_to_async(func):
+    return ExecutorSyncToAsync(func, thread_sensitive=False, executor=get_db_executor())
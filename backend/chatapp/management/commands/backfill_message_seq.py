@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chatapp.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = "Assign per-conversation sequence numbers to messages created before Message.seq existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        processed = 0
+        assigned = 0
+
+        conversation_ids = (
+            Message.objects.filter(seq__isnull=True)
+            .order_by("conversation_id")
+            .values_list("conversation_id", flat=True)
+            .distinct()
+        )
+        for cid in conversation_ids.iterator(chunk_size=chunk_size):
+            with transaction.atomic():
+                # Locks the counter row so live inserts queue behind the backfill
+                # instead of racing it for the same numbers.
+                conversation = Conversation.objects.select_for_update().get(cid=cid)
+                last_seq = conversation.last_seq
+                while True:
+                    messages = list(
+                        Message.objects.filter(conversation_id=cid, seq__isnull=True)
+                        .order_by("mid")
+                        .only("mid", "seq")[:chunk_size]
+                    )
+                    if not messages:
+                        break
+                    for message in messages:
+                        last_seq += 1
+                        message.seq = last_seq
+                    Message.objects.bulk_update(messages, ["seq"])
+                    assigned += len(messages)
+                Conversation.objects.filter(cid=cid).update(last_seq=last_seq)
+
+            processed += 1
+            if processed % chunk_size == 0:
+                self.stdout.write(f"Backfilled {processed} conversations")
+
+        self.stdout.write(self.style.SUCCESS(f"Assigned {assigned} sequence numbers in {processed} conversations"))
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from chatapp.models import Conversation, Message, ReadPointer
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill ReadPointer seq watermarks and unread counters from the legacy Message.is_read flag "
+        "(run backfill_message_seq first)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        fallback_staff_id = (
+            CustomUser.objects.filter(is_staff=True).order_by("id").values_list("id", flat=True).first()
+        )
+        processed = 0
+
+        conversations = Conversation.objects.order_by("cid").iterator(chunk_size=chunk_size)
+        for conversation in conversations:
+            messages = Message.objects.filter(conversation=conversation)
+            owner_messages = messages.filter(sender_id=conversation.user_id)
+            staff_messages = messages.exclude(sender_id=conversation.user_id)
+
+            user_read_seq = staff_messages.filter(is_read=True).aggregate(m=Max("seq"))["m"] or 0
+            staff_read_seq = owner_messages.filter(is_read=True).aggregate(m=Max("seq"))["m"] or 0
+            staff_reader_id = (
+                staff_messages.order_by("-mid").values_list("sender_id", flat=True).first()
+                or fallback_staff_id
+            )
+
+            with transaction.atomic():
+                if user_read_seq:
+                    self.advance(conversation, conversation.user_id, user_read_seq)
+                if staff_read_seq and staff_reader_id:
+                    self.advance(conversation, staff_reader_id, staff_read_seq)
+                Conversation.objects.filter(cid=conversation.cid).update(
+                    user_unread_count=staff_messages.filter(seq__gt=user_read_seq).count(),
+                    staff_unread_count=owner_messages.filter(seq__gt=staff_read_seq).count()
+                )
+
+            processed += 1
+            if processed % chunk_size == 0:
+                self.stdout.write(f"Backfilled {processed} conversations")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled read pointers for {processed} conversations"))
+
+    def advance(self, conversation, user_id, last_read_seq):
+        pointer, created = ReadPointer.objects.get_or_create(
+            conversation=conversation,
+            user_id=user_id,
+            defaults={"last_read_seq": last_read_seq}
+        )
+        if not created and pointer.last_read_seq < last_read_seq:
+            pointer.last_read_seq = last_read_seq
+            pointer.save(update_fields=["last_read_seq", "updated_at"])
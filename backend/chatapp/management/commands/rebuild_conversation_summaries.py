@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chatapp.models import Conversation, Message
+from chatapp.services import last_message_fields, read_watermarks
+
+
+class Command(BaseCommand):
+    help = "Rebuild each conversation's last-message summary and unread counters (run backfill_message_seq first)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        processed = 0
+
+        conversation_ids = Conversation.objects.order_by("cid").values_list("cid", flat=True)
+        for cid in conversation_ids.iterator(chunk_size=chunk_size):
+            with transaction.atomic():
+                # Locks the row so a concurrent save_messages can't slip a
+                # newer message in between the read and the update.
+                conversation = Conversation.objects.select_for_update().get(cid=cid)
+                messages = Message.objects.filter(conversation=conversation)
+                last_message = messages.filter(seq__isnull=False).order_by("-seq").first()
+                if last_message:
+                    summary = last_message_fields(last_message)
+                else:
+                    summary = {"last_message": None, "last_message_at": None, "last_message_preview": ""}
+
+                watermarks = read_watermarks(conversation)
+                owner_messages = messages.filter(sender_id=conversation.user_id)
+                staff_messages = messages.exclude(sender_id=conversation.user_id)
+                Conversation.objects.filter(cid=cid).update(
+                    user_unread_count=staff_messages.filter(seq__gt=watermarks["user"]).count(),
+                    staff_unread_count=owner_messages.filter(seq__gt=watermarks["staff"]).count(),
+                    **summary
+                )
+
+            processed += 1
+            if processed % chunk_size == 0:
+                self.stdout.write(f"Rebuilt {processed} conversations")
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt summaries for {processed} conversations"))
@@ -0,0 +1,42 @@
+import threading
+from collections import Counter
+
+# Process-local metrics. Counters only go up; gauges hold the last value;
+# observations keep count, sum and max. MetricsView exposes a snapshot for
+# the ASGI process that serves the request.
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+_observations = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, value):
+    with _lock:
+        stats = _observations.get(name)
+        if stats is None:
+            stats = _observations[name] = {"count": 0, "sum": 0.0, "max": value}
+        stats["count"] += 1
+        stats["sum"] += value
+        stats["max"] = max(stats["max"], value)
+
+
+def snapshot():
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "observations": {
+                name: {**stats, "avg": stats["sum"] / stats["count"]}
+                for name, stats in _observations.items()
+            }
+        }
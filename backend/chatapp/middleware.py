@@ -1,8 +1,8 @@
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
-from users.models import CustomUser
+from users.cache import get_cached_user
+from .db import db_sync_to_async
 import logging
 
 logger = logging.getLogger(__name__)
@@ -33,12 +33,12 @@ class JWTAuthMiddleware(BaseMiddleware):
 
         return await super().__call__(scope, receive, send)
 
-    @database_sync_to_async
+    @db_sync_to_async
     def get_user(self, user_id):
-        try:
-            return CustomUser.objects.get(id=user_id)
-        except CustomUser.DoesNotExist:
+        user = get_cached_user(user_id)
+        if user is None or not user.is_active:
             return AnonymousUser()
+        return user
 
 
 def JWTAuthMiddlewareStack(inner):
@@ -1,14 +1,29 @@
 from django.db import models
+from django.utils import timezone
 from django.utils.text import slugify
 from users.models import CustomUser
 import uuid
 # Create your models here.
 
+PREVIEW_LENGTH = 120
+
 class Conversation(models.Model):
     cid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name="conversations")
     slug = models.SlugField(unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    user_unread_count = models.PositiveIntegerField(default=0)
+    staff_unread_count = models.PositiveIntegerField(default=0)
+    # Highest Message.seq handed out in this conversation.
+    last_seq = models.PositiveIntegerField(default=0)
+    # Inbox summary, kept current by save_messages in the insert transaction
+    # and rebuilt by the rebuild_conversation_summaries command. Null until
+    # the first message.
+    last_message = models.ForeignKey(
+        "Message", null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default="")
 
     class Meta:
         constraints = [
@@ -17,7 +32,20 @@ class Conversation(models.Model):
                 name="only_one_conversation_per_user"
             )
         ]
+        indexes = [
+            models.Index(fields=["-last_message_at", "-cid"], name="conversation_inbox_idx"),
+            # Only conversations waiting on staff; keeps the total_unread sum
+            # proportional to the backlog, not to the number of users.
+            models.Index(
+                fields=["staff_unread_count"],
+                condition=models.Q(staff_unread_count__gt=0),
+                name="conversation_staff_unread_idx"
+            ),
+        ]
     
+    def unread_field_for(self, user):
+        return "user_unread_count" if user.id == self.user_id else "staff_unread_count"
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = f"{slugify(self.user.first_name)}-{slugify(self.user.last_name)}-{self.user.id}"
@@ -33,17 +61,61 @@ class Message(models.Model):
     mid = models.AutoField(primary_key=True)
     conversation = models.ForeignKey(Conversation,on_delete=models.CASCADE,related_name="messages")
     sender = models.ForeignKey(CustomUser,on_delete=models.CASCADE,related_name="sent_messages")
+    # Legacy flag, no longer written. Read state comes from ReadPointer
+    # watermarks; see the backfill_read_pointers command.
     is_read = models.BooleanField(default=False)
     message = models.TextField(null=True, blank=True)
     image = models.URLField(null=True, blank=True)
     message_type = models.CharField(choices=MESSAGE_TYPES, default="TEXT", max_length=10)
-    timestamp = models.DateTimeField(auto_now_add=True) 
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Gap-free per-conversation sequence assigned by save_messages; clients
+    # resume with ?since=<seq>. Null only for rows predating the column
+    # until backfill_message_seq has run.
+    seq = models.PositiveIntegerField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return self.message
+
+    def preview(self):
+        if self.message_type == "IMAGE":
+            return "Image"
+        return (self.message or "")[:PREVIEW_LENGTH]
     
+    # No default ordering: every query orders explicitly, so counts and
+    # aggregates don't pay for a sort. The indexes match the history
+    # (newest first) and per-sender unread queries; seq replay uses the
+    # unique constraint's index.
     class Meta:
-        ordering = ['timestamp']
+        constraints = [
+            models.UniqueConstraint(
+                fields=["conversation", "seq"],
+                name="unique_message_seq_per_conversation"
+            )
+        ]
+        indexes = [
+            models.Index(fields=["conversation", "timestamp"], name="message_history_idx"),
+            models.Index(fields=["conversation", "sender", "seq"], name="message_sender_seq_idx"),
+        ]
+
+class ReadPointer(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="read_pointers")
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="read_pointers")
+    # Highest Message.seq read. Seqs are assigned in commit order, unlike
+    # mids under write-behind, so nothing committed later can fall below it.
+    last_read_seq = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["conversation", "user"],
+                name="one_read_pointer_per_participant"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.conversation_id} up to {self.last_read_seq}"
+
 
 class Notification(models.Model):
     nid = models.AutoField(primary_key=True)
@@ -52,5 +124,25 @@ class Notification(models.Model):
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "is_read", "-created_at"], name="notification_inbox_idx"),
+        ]
+
+    def __str__(self):
+        return self.notification
+
+# Side effects of a write (notifications, analytics) recorded in the same
+# transaction and performed later by the drain_outbox task.
+class OutboxEvent(models.Model):
+    MESSAGE_CREATED = "message.created"
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    claim_token = models.UUIDField(null=True, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
     def __str__(self):
-        return self.notification
\ No newline at end of file
+        return f"{self.kind} #{self.pk}"
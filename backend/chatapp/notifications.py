@@ -0,0 +1,169 @@
+import json
+from collections import Counter
+from django.conf import settings
+from .presence import get_redis, get_script
+import logging
+
+logger = logging.getLogger(__name__)
+
+PENDING_RECIPIENTS = "notification:pending"
+FLUSH_SCHEDULED = "notification:flush_scheduled"
+FLUSH_LOCK = "notification:flush_lock"
+FLUSH_LOCK_TTL = 60
+NOTIFICATION_KEY_TTL = 60 * 60 * 24
+
+# KEYS: pending set, flush flag, then (idempotency key, buffer key) per item.
+# ARGV: key ttl, flush ttl, then (recipient id, entry) per item, so item
+# offsets line up with KEYS. The claim and the RPUSH happen in one script,
+# so a key is never taken without its entry being queued. Returns 1 when
+# the caller should schedule a flush.
+BUFFER_ONCE_SCRIPT = """
+local buffered = 0
+for i = 3, #KEYS, 2 do
+    if redis.call('SET', KEYS[i], 1, 'NX', 'EX', ARGV[1]) then
+        redis.call('RPUSH', KEYS[i + 1], ARGV[i + 1])
+        redis.call('SADD', KEYS[1], ARGV[i])
+        buffered = buffered + 1
+    end
+end
+if buffered > 0 and redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: pending set, then a buffer key per recipient. ARGV: (recipient id,
+# entries read) per recipient. Trims only what the flush read, so entries
+# buffered mid-flush stay queued, and keeps the recipient pending while any
+# remain.
+ACK_SCRIPT = """
+for i = 2, #KEYS do
+    redis.call('LTRIM', KEYS[i], ARGV[2 * i - 2], -1)
+    if redis.call('LLEN', KEYS[i]) == 0 then
+        redis.call('SREM', KEYS[1], ARGV[2 * i - 3])
+    end
+end
+return 0
+"""
+
+
+def notification_config():
+    return getattr(settings, "CHAT_NOTIFICATIONS", {})
+
+
+def digest_window():
+    return notification_config().get("DIGEST_WINDOW", 5)
+
+
+def notification_key(message_id):
+    return f"notification:{message_id}"
+
+
+def buffer_key(recipient_id):
+    return f"notification:buffer:{recipient_id}"
+
+
+def notification_text(entry):
+    if entry["type"] == "image":
+        return f'{entry["sender"]} has sent an image'
+    return f'{entry["sender"]} has sent "{entry["message"]}".'
+
+
+# A single buffered notification keeps its original wording; a burst becomes
+# one line per sender ("Jane Doe sent 30 messages").
+def digest_text(entries):
+    if len(entries) == 1:
+        return notification_text(entries[0])
+    counts = Counter(entry["sender"] for entry in entries)
+    return "; ".join(
+        f"{sender} sent {count} messages" if count > 1 else notification_text(
+            next(entry for entry in entries if entry["sender"] == sender)
+        )
+        for sender, count in counts.items()
+    )
+
+
+# Returns True when the caller should schedule a flush for this window. The
+# entry is queued before the schedule flag is checked, so a flush that has
+# already cleared the flag is guaranteed to see it or leave it for the next.
+def buffer_notification(recipient_id, entry):
+    return buffer_notifications([(recipient_id, entry)])
+
+
+def buffer_notifications(items):
+    if not items:
+        return False
+    client = get_redis()
+    pipe = client.pipeline(transaction=True)
+    for recipient_id, entry in items:
+        pipe.rpush(buffer_key(recipient_id), json.dumps(entry))
+        pipe.sadd(PENDING_RECIPIENTS, str(recipient_id))
+    pipe.set(FLUSH_SCHEDULED, 1, nx=True, ex=digest_window() * 2)
+    return bool(pipe.execute()[-1])
+
+
+# Like buffer_notifications, for (message_id, recipient_id, entry) items:
+# messages that were already notified are skipped, so retried deliveries
+# and redelivered tasks queue each message once.
+def buffer_notifications_once(items):
+    if not items:
+        return False
+    keys = [PENDING_RECIPIENTS, FLUSH_SCHEDULED]
+    args = [NOTIFICATION_KEY_TTL, digest_window() * 2]
+    for message_id, recipient_id, entry in items:
+        keys += [notification_key(message_id), buffer_key(recipient_id)]
+        args += [str(recipient_id), json.dumps(entry)]
+    return bool(get_script(BUFFER_ONCE_SCRIPT)(keys=keys, args=args))
+
+
+# Reads every buffered entry, grouped by recipient, and returns them with
+# how many raw entries were read per recipient. Nothing is removed here:
+# the caller acks the counts once the notifications are written, so a failed
+# flush leaves them for the next one. The flush lock keeps two flushes from
+# reading the same entries; None means another flush holds it. Clearing
+# the schedule flag first lets notifications arriving mid-flush schedule the
+# next window.
+def drain_notification_buffers():
+    client = get_redis()
+    if not client.set(FLUSH_LOCK, 1, nx=True, ex=FLUSH_LOCK_TTL):
+        return None
+    client.delete(FLUSH_SCHEDULED)
+
+    recipient_ids = [
+        raw_id.decode() if isinstance(raw_id, bytes) else str(raw_id)
+        for raw_id in client.smembers(PENDING_RECIPIENTS)
+    ]
+    if not recipient_ids:
+        return {}, {}
+
+    pipe = client.pipeline(transaction=True)
+    for recipient_id in recipient_ids:
+        pipe.lrange(buffer_key(recipient_id), 0, -1)
+    results = pipe.execute()
+
+    buffers, read = {}, {}
+    for recipient_id, raw_entries in zip(recipient_ids, results):
+        read[recipient_id] = len(raw_entries)
+        entries = []
+        for raw in raw_entries:
+            try:
+                entries.append(json.loads(raw))
+            except ValueError:
+                logger.warning(f"Dropping malformed buffered notification for {recipient_id}")
+        if entries:
+            buffers[recipient_id] = entries
+    return buffers, read
+
+
+def ack_notification_buffers(read):
+    if read:
+        keys = [PENDING_RECIPIENTS]
+        args = []
+        for recipient_id, count in read.items():
+            keys.append(buffer_key(recipient_id))
+            args += [recipient_id, count]
+        get_script(ACK_SCRIPT)(keys=keys, args=args)
+
+
+def release_notification_flush():
+    get_redis().delete(FLUSH_LOCK)
@@ -0,0 +1,196 @@
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from users.models import CustomUser
+from .context import get_user_cards
+from .models import OutboxEvent
+from .notifications import NOTIFICATION_KEY_TTL, buffer_notifications_once
+from .presence import get_redis, get_room_presences, get_script
+import logging
+
+logger = logging.getLogger(__name__)
+
+DRAIN_SCHEDULED = "outbox:drain_scheduled"
+ANALYTICS_TTL = 60 * 60 * 24 * 30
+
+# KEYS: daily counter hash, then one marker per message. ARGV: hash ttl,
+# marker ttl, then the message types. Each message is counted once, so a
+# batch retried after a partial failure doesn't count it again.
+COUNT_MESSAGES_SCRIPT = """
+for i = 2, #KEYS do
+    if redis.call('SET', KEYS[i], 1, 'NX', 'EX', ARGV[2]) then
+        redis.call('HINCRBY', KEYS[1], ARGV[i + 1], 1)
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+"""
+
+
+def outbox_config():
+    return getattr(settings, "CHAT_OUTBOX", {})
+
+
+def message_events(messages):
+    return [
+        OutboxEvent(
+            kind=OutboxEvent.MESSAGE_CREATED,
+            payload={
+                "message_id": message.mid,
+                "conversation_id": str(message.conversation_id),
+                "owner_id": message.conversation.user_id,
+                "sender_id": message.sender_id,
+                "message_type": message.message_type,
+                "message": message.message,
+            }
+        )
+        for message in messages
+    ]
+
+
+# Called on commit of every write that adds events. At most one drain is
+# queued per DRAIN_DELAY, so the write path pays a SET NX instead of a
+# broker round trip per message; the beat schedule covers a lost kick.
+def schedule_drain():
+    try:
+        delay = outbox_config().get("DRAIN_DELAY", 1)
+        if get_redis().set(DRAIN_SCHEDULED, 1, nx=True, ex=max(delay * 2, 1)):
+            from .tasks import drain_outbox
+            drain_outbox.apply_async(countdown=delay)
+    except Exception as e:
+        logger.error(f"Error scheduling outbox drain: {e}")
+
+
+def record_events(events):
+    OutboxEvent.objects.bulk_create(events)
+    transaction.on_commit(schedule_drain)
+
+
+# Leases up to BATCH_SIZE events to this worker. Events whose lease ran out
+# (worker died mid-batch, or a failed event's retry delay passed) are
+# claimable again; completed events are deleted. Events that failed
+# MAX_ATTEMPTS times stay in the table as dead letters until someone resets
+# their attempts.
+def claim_batch():
+    config = outbox_config()
+    now = timezone.now()
+    token = uuid.uuid4()
+    claimable = (
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+    ) & Q(attempts__lt=config.get("MAX_ATTEMPTS", 10))
+    ids = list(
+        OutboxEvent.objects.filter(claimable)
+        .order_by("id")
+        .values_list("id", flat=True)[:config.get("BATCH_SIZE", 500)]
+    )
+    if not ids:
+        return []
+    # Conditional on still being claimable, so concurrent drains never
+    # lease the same event twice.
+    OutboxEvent.objects.filter(claimable, id__in=ids).update(
+        claim_token=token,
+        claimed_until=now + timedelta(seconds=config.get("LEASE_SECONDS", 60))
+    )
+    return list(OutboxEvent.objects.filter(claim_token=token).order_by("id"))
+
+
+def complete(events):
+    OutboxEvent.objects.filter(id__in=[event.id for event in events]).delete()
+
+
+# Puts failed events back with an exponential retry delay, so a Redis
+# outage burns through attempts slowly while a poison event still ends up
+# dead-lettered.
+def release(events):
+    config = outbox_config()
+    now = timezone.now()
+    max_attempts = config.get("MAX_ATTEMPTS", 10)
+    for event in events:
+        event.attempts += 1
+        event.claim_token = None
+        event.claimed_until = now + timedelta(
+            seconds=config.get("RETRY_DELAY", 10) * 2 ** (event.attempts - 1)
+        )
+        if event.attempts >= max_attempts:
+            logger.error(f"Outbox event {event.pk} failed {event.attempts} times, dead-lettered")
+    OutboxEvent.objects.bulk_update(events, ["attempts", "claim_token", "claimed_until"])
+
+
+# Returns (completed, flush). A batch that fails is retried one event at a
+# time, so a single bad event is released on its own instead of holding
+# back the rest. Processing is idempotent, so events that went through
+# before the failure are not notified or counted twice.
+def handle_batch(events):
+    try:
+        flush = process(events)
+    except Exception as e:
+        logger.error(f"Error processing {len(events)} outbox events: {e}", exc_info=True)
+        flush, done, failed = False, [], []
+        for event in events:
+            try:
+                flush = process([event]) or flush
+                done.append(event)
+            except Exception as e:
+                logger.error(f"Error processing outbox event {event.pk}: {e}", exc_info=True)
+                failed.append(event)
+        release(failed)
+        events = done
+    complete(events)
+    return len(events), flush
+
+
+# Returns True when a digest flush has to be scheduled.
+def process(events):
+    messages = [event.payload for event in events if event.kind == OutboxEvent.MESSAGE_CREATED]
+    if not messages:
+        return False
+    emit_message_analytics(messages)
+    return notify_recipients(messages)
+
+
+def emit_message_analytics(messages):
+    key = f"analytics:messages:{timezone.localdate().isoformat()}"
+    get_script(COUNT_MESSAGES_SCRIPT)(
+        keys=[key] + [f"analytics:counted:{payload['message_id']}" for payload in messages],
+        args=[ANALYTICS_TTL, NOTIFICATION_KEY_TTL] + [payload["message_type"] for payload in messages]
+    )
+    logger.info(f"Outbox recorded {len(messages)} messages")
+
+
+def notify_recipients(messages):
+    staff_id = None
+    if any(payload["sender_id"] == payload["owner_id"] for payload in messages):
+        staff_id = (
+            CustomUser.objects.filter(is_staff=True)
+            .order_by("id")
+            .values_list("id", flat=True)
+            .first()
+        )
+
+    pending = []
+    for payload in messages:
+        recipient_id = staff_id if payload["sender_id"] == payload["owner_id"] else payload["owner_id"]
+        if recipient_id is not None:
+            pending.append((payload, str(recipient_id)))
+    if not pending:
+        return False
+
+    # Recipients with the conversation open see the message live.
+    presences = get_room_presences([(payload["conversation_id"], recipient_id) for payload, recipient_id in pending])
+    pending = [
+        (payload, recipient_id)
+        for (payload, recipient_id), (_, in_room) in zip(pending, presences)
+        if not in_room
+    ]
+
+    senders = {card["id"]: card["name"] for card in get_user_cards({payload["sender_id"] for payload, _ in pending})}
+    return buffer_notifications_once([
+        (payload["message_id"], recipient_id, {
+            "sender": senders.get(str(payload["sender_id"]), ""),
+            "type": "image" if payload["message_type"] == "IMAGE" else "message",
+            "message": payload["message"],
+        })
+        for payload, recipient_id in pending
+    ])
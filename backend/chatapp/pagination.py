@@ -6,4 +6,18 @@ class MessageInfiniteScrollPagination(CursorPagination):
     page_size = 35
     ordering = '-timestamp' 
     cursor_query_param = 'cursor'
-    
\ No newline at end of file
+
+
+class UnreadReplayPagination(CursorPagination):
+
+    page_size = 50
+    ordering = 'seq'
+    cursor_query_param = 'cursor'
+
+
+class StaffInboxPagination(CursorPagination):
+
+    page_size = 30
+    ordering = ('-last_message_at', '-cid')
+    cursor_query_param = 'cursor'
+
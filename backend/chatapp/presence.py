@@ -0,0 +1,331 @@
+from django.core.cache import cache
+from django.utils import timezone
+from .redis_async import get_async_redis, get_async_script
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATUS_CHANNEL = "user_status_channel"
+ONLINE_USERS = "online_users"
+ONLINE_STAFF = "online_staff"
+OFFLINE_TTL = 60
+
+# Presence lives in one hash per user (conns, status, hb, staff). Each script
+# updates the hash, its TTL, the online set and publishes the transition in a
+# single round trip, so concurrent connects can no longer lose counts.
+# Every transition also bumps the online set's version so subscribers can
+# tell when they missed a delta and need a fresh snapshot.
+CONNECT_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], 'conns', 1)
+redis.call('HSET', KEYS[1], 'status', 'online', 'hb', ARGV[2], 'staff', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[1])
+if count == 1 then
+    local version = redis.call('INCR', KEYS[3])
+    redis.call('PUBLISH', ARGV[5], cjson.encode({
+        user_id = ARGV[1], status = 'online', is_staff = ARGV[4] == '1', version = version
+    }))
+end
+return count
+"""
+
+DISCONNECT_SCRIPT = """
+local count = tonumber(redis.call('HGET', KEYS[1], 'conns') or '0')
+if count > 1 then
+    local remaining = redis.call('HINCRBY', KEYS[1], 'conns', -1)
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return remaining
+end
+redis.call('HSET', KEYS[1], 'conns', 0, 'status', 'offline')
+redis.call('HDEL', KEYS[1], 'hb')
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+local removed = redis.call('SREM', KEYS[2], ARGV[1])
+if count == 1 or removed == 1 then
+    local version = redis.call('INCR', KEYS[3])
+    redis.call('PUBLISH', ARGV[5], cjson.encode({
+        user_id = ARGV[1], status = 'offline', is_staff = ARGV[4] == '1', version = version
+    }))
+end
+return 0
+"""
+
+# With ARGV[4] == '1' the clear only happens while the user has no
+# connections, checked in the same call so a reconnect that lands after a
+# stale check isn't wiped. Returns 1 when the presence was cleared.
+CLEAR_SCRIPT = """
+if ARGV[4] == '1' and tonumber(redis.call('HGET', KEYS[1], 'conns') or '0') > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+    local version = redis.call('INCR', KEYS[3])
+    redis.call('PUBLISH', ARGV[3], cjson.encode({
+        user_id = ARGV[1], status = 'offline', is_staff = ARGV[2] == '1', version = version
+    }))
+end
+return 1
+"""
+
+HEARTBEAT_SCRIPT = """
+local count = tonumber(redis.call('HGET', KEYS[1], 'conns') or '0')
+if count > 0 then
+    redis.call('HSET', KEYS[1], 'status', 'online', 'hb', ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+return count
+"""
+
+# Per-conversation presence: one hash per room mapping user id to the number
+# of that user's sockets subscribed to the conversation.
+ROOM_LEAVE_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if count <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return count
+"""
+
+ROOM_TTL = 60 * 60 * 24
+
+_client = None
+_scripts = {}
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        try:
+            _client = cache.client.get_client(write=True)
+        except Exception as e:
+            logger.error(f"Redis connection error: {e}")
+    return _client
+
+
+def get_script(source):
+    script = _scripts.get(source)
+    if script is None:
+        script = get_redis().register_script(source)
+        _scripts[source] = script
+    return script
+
+
+def presence_key(user_id):
+    return f"presence:{user_id}"
+
+
+def online_set_name(is_staff):
+    return ONLINE_STAFF if is_staff else ONLINE_USERS
+
+
+def version_key(online_set):
+    return f"presence:version:{online_set}"
+
+
+def room_presence_key(cid):
+    return f"presence:room:{cid}"
+
+
+def get_connection_count(user_id):
+    client = get_redis()
+    if not client:
+        return 0
+    count = client.hget(presence_key(user_id), "conns")
+    return int(count) if count else 0
+
+
+def get_status(user_id):
+    client = get_redis()
+    if not client:
+        return "offline"
+    status = client.hget(presence_key(user_id), "status")
+    return status.decode() if status else "offline"
+
+
+def get_statuses(user_ids):
+    client = get_redis()
+    if not client or not user_ids:
+        return {str(user_id): "offline" for user_id in user_ids}
+    pipe = client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hget(presence_key(user_id), "status")
+    return {
+        str(user_id): status.decode() if status else "offline"
+        for user_id, status in zip(user_ids, pipe.execute())
+    }
+
+
+# Read-only counterpart of get_presence_snapshot for HTTP views: members
+# whose connection hash expired are skipped here and cleared by the next
+# socket snapshot.
+def get_online_members(online_set):
+    client = get_redis()
+    if not client:
+        return []
+    candidate_ids = [
+        raw_id.decode() if isinstance(raw_id, bytes) else str(raw_id)
+        for raw_id in client.smembers(online_set)
+    ]
+    pipe = client.pipeline(transaction=False)
+    for user_id in candidate_ids:
+        pipe.hget(presence_key(user_id), "conns")
+    return [
+        user_id
+        for user_id, count in zip(candidate_ids, pipe.execute())
+        if count and int(count) > 0
+    ]
+
+
+async def get_online_ids(online_set):
+    return (await get_presence_snapshot(online_set))[1]
+
+
+async def get_presence_snapshot(online_set):
+    client = get_async_redis()
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.get(version_key(online_set))
+        pipe.smembers(online_set)
+        version, members = await pipe.execute()
+    version = int(version) if version else 0
+    candidate_ids = [
+        raw_id.decode() if isinstance(raw_id, bytes) else str(raw_id)
+        for raw_id in members
+    ]
+    if not candidate_ids:
+        return version, []
+
+    async with client.pipeline(transaction=False) as pipe:
+        for user_id in candidate_ids:
+            pipe.hget(presence_key(user_id), "conns")
+        counts = await pipe.execute()
+
+    online_ids, stale_ids = [], []
+    for user_id, count in zip(candidate_ids, counts):
+        if count and int(count) > 0:
+            online_ids.append(user_id)
+        else:
+            stale_ids.append(user_id)
+    if stale_ids:
+        # Clearing publishes the offline transition, so subscribers that still
+        # list an expired user get a delta instead of silently diverging.
+        script = get_async_script(CLEAR_SCRIPT)
+        async with client.pipeline(transaction=False) as pipe:
+            for user_id in stale_ids:
+                await script(
+                    keys=[presence_key(user_id), online_set, version_key(online_set)],
+                    args=[user_id, "1" if online_set == ONLINE_STAFF else "0", STATUS_CHANNEL, "1"],
+                    client=pipe
+                )
+            await pipe.execute()
+    return version, online_ids
+
+
+# Returns how many of the user's sockets are now in the room.
+async def join_room(cid, user_id):
+    async with get_async_redis().pipeline(transaction=True) as pipe:
+        pipe.hincrby(room_presence_key(cid), str(user_id), 1)
+        pipe.expire(room_presence_key(cid), ROOM_TTL)
+        return (await pipe.execute())[0]
+
+
+async def leave_room(cid, user_id):
+    await get_async_script(ROOM_LEAVE_SCRIPT)(keys=[room_presence_key(cid)], args=[str(user_id)])
+
+
+# Returns (online, in_room) for a user in one round trip. The room count is
+# only trusted while the user is online, so a worker that died without
+# leaving its rooms can't suppress notifications past presence cleanup.
+def get_room_presence(cid, user_id):
+    return get_room_presences([(cid, user_id)])[0]
+
+
+def get_room_presences(pairs):
+    client = get_redis()
+    if not client:
+        return [(False, False) for _ in pairs]
+    pipe = client.pipeline(transaction=False)
+    for cid, user_id in pairs:
+        pipe.hget(presence_key(user_id), "conns")
+        pipe.hget(room_presence_key(cid), str(user_id))
+    results = pipe.execute()
+    presences = []
+    for conns, room_conns in zip(results[::2], results[1::2]):
+        online = bool(conns) and int(conns) > 0
+        presences.append((online, online and bool(room_conns) and int(room_conns) > 0))
+    return presences
+
+
+# only_stale leaves users who have reconnected since the caller's check.
+def clear_presence(user_id, is_staff=False, only_stale=False):
+    if not get_redis():
+        return False
+    online_set = online_set_name(is_staff)
+    return bool(get_script(CLEAR_SCRIPT)(
+        keys=[presence_key(user_id), online_set, version_key(online_set)],
+        args=[str(user_id), "1" if is_staff else "0", STATUS_CHANNEL, "1" if only_stale else "0"]
+    ))
+
+
+class ConnectionCounter:
+    TTL = 30
+
+    def __init__(self, user_id, is_staff=False):
+        self.user_id = str(user_id)
+        self.key = presence_key(self.user_id)
+        self.online_set = online_set_name(is_staff)
+        self.version_key = version_key(self.online_set)
+        self.is_staff = is_staff
+
+    @property
+    def staff_flag(self):
+        return "1" if self.is_staff else "0"
+
+    # Rooms the socket is already in are joined in the same round trip.
+    async def increment(self, rooms=()):
+        try:
+            async with get_async_redis().pipeline(transaction=False) as pipe:
+                await get_async_script(CONNECT_SCRIPT)(
+                    keys=[self.key, self.online_set, self.version_key],
+                    args=[self.user_id, timezone.now().timestamp(), self.TTL, self.staff_flag, STATUS_CHANNEL],
+                    client=pipe
+                )
+                for cid in rooms:
+                    pipe.hincrby(room_presence_key(cid), self.user_id, 1)
+                    pipe.expire(room_presence_key(cid), ROOM_TTL)
+                return (await pipe.execute())[0]
+        except Exception as e:
+            logger.error(f"Error incrementing connection count: {e}")
+            return 1
+
+    async def decrement(self):
+        try:
+            return await get_async_script(DISCONNECT_SCRIPT)(
+                keys=[self.key, self.online_set, self.version_key],
+                args=[self.user_id, self.TTL, OFFLINE_TTL, self.staff_flag, STATUS_CHANNEL]
+            )
+        except Exception as e:
+            logger.error(f"Error decrementing connection count: {e}")
+            return 0
+
+    async def get_count(self):
+        try:
+            count = await get_async_redis().hget(self.key, "conns")
+            return int(count) if count else 0
+        except Exception as e:
+            logger.error(f"Error getting connection count: {e}")
+            return 0
+
+    async def heartbeat(self):
+        try:
+            count = await get_async_script(HEARTBEAT_SCRIPT)(
+                keys=[self.key, self.online_set],
+                args=[self.user_id, timezone.now().timestamp(), self.TTL]
+            )
+            if count:
+                logger.debug(f"Heartbeat updated for user {self.user_id}")
+        except Exception as e:
+            logger.error(f"Error updating heartbeat: {e}")
+
+    async def is_online(self):
+        count = await self.get_count()
+        return count > 0
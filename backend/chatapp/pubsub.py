@@ -0,0 +1,146 @@
+import asyncio
+import json
+import weakref
+from .redis_async import get_async_redis
+import logging
+
+logger = logging.getLogger(__name__)
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_pubsub_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = PubSubHub()
+        _hubs[loop] = hub
+    return hub
+
+
+# Each subscribed handler gets its own queue and task, so a slow socket only
+# delays itself. When the queue is full new events are dropped; presence
+# handlers notice the version gap and resync from a snapshot.
+class Subscription:
+    BUFFER = 100
+
+    def __init__(self, channel, handler):
+        self.channel = channel
+        self.handler = handler
+        self.queue = asyncio.Queue(maxsize=self.BUFFER)
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def deliver(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning(f"Pub/sub subscriber on {self.channel} is behind, dropping an event")
+
+    async def run(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                await self.handler(payload)
+            except Exception as e:
+                logger.error(f"Pub/sub handler error on {self.channel}: {e}", exc_info=True)
+
+    def close(self):
+        self.task.cancel()
+
+
+# Runs a channel's ``prepare`` coroutine once per event, in order, before
+# fanning out, so work every subscriber would repeat (a DB lookup) is done
+# once per process instead of once per socket.
+class PreparedFeed:
+    def __init__(self, channel, prepare, subscriptions):
+        self.channel = channel
+        self.prepare = prepare
+        self.subscriptions = subscriptions
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                payload = await self.prepare(payload)
+            except Exception as e:
+                logger.error(f"Pub/sub prepare error on {self.channel}: {e}", exc_info=True)
+            for subscription in list(self.subscriptions.values()):
+                subscription.deliver(payload)
+
+    def close(self):
+        self.task.cancel()
+
+
+# One Redis pub/sub connection per process, fanned out to local consumers.
+# The listener only parses and enqueues; it never awaits a handler.
+class PubSubHub:
+    def __init__(self):
+        self.pubsub = None
+        self.subscriptions = {}
+        self.feeds = {}
+        self.listener = None
+        self.lock = asyncio.Lock()
+
+    async def publish(self, channel, payload):
+        await get_async_redis().publish(channel, json.dumps(payload))
+
+    async def subscribe(self, channel, handler, prepare=None):
+        async with self.lock:
+            if self.pubsub is None:
+                self.pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+            subscriptions = self.subscriptions.setdefault(channel, {})
+            if not subscriptions:
+                await self.pubsub.subscribe(channel)
+            if handler not in subscriptions:
+                subscriptions[handler] = Subscription(channel, handler)
+            if prepare is not None and channel not in self.feeds:
+                self.feeds[channel] = PreparedFeed(channel, prepare, subscriptions)
+            if self.listener is None or self.listener.done():
+                self.listener = asyncio.get_running_loop().create_task(self.listen())
+
+    async def unsubscribe(self, channel, handler):
+        async with self.lock:
+            subscriptions = self.subscriptions.get(channel)
+            if not subscriptions:
+                return
+            subscription = subscriptions.pop(handler, None)
+            if subscription:
+                subscription.close()
+            if not subscriptions:
+                del self.subscriptions[channel]
+                feed = self.feeds.pop(channel, None)
+                if feed:
+                    feed.close()
+                await self.pubsub.unsubscribe(channel)
+
+    def dispatch(self, channel, payload):
+        feed = self.feeds.get(channel)
+        if feed is not None:
+            feed.queue.put_nowait(payload)
+            return
+        for subscription in list(self.subscriptions.get(channel, {}).values()):
+            subscription.deliver(payload)
+
+    async def listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Pub/sub listener error: {e}", exc_info=True)
+                await asyncio.sleep(1.0)
+                continue
+            if not message:
+                continue
+
+            channel = message["channel"]
+            channel = channel.decode() if isinstance(channel, bytes) else channel
+            try:
+                payload = json.loads(message["data"])
+            except (TypeError, ValueError):
+                logger.warning(f"Dropping malformed pub/sub payload on {channel}")
+                continue
+            self.dispatch(channel, payload)
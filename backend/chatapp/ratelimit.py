@@ -0,0 +1,72 @@
+import math
+from django.conf import settings
+from .presence import get_redis
+from .redis_async import get_async_script
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = "ratelimit:stats"
+
+# Token bucket per user and event type, refilled at RATE tokens per second
+# up to BURST. Uses the Redis clock so every worker sees the same bucket,
+# and counts allowed/limited calls per event type for monitoring.
+# Returns {allowed, retry_after_ms}.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('HINCRBY', KEYS[2], ARGV[3] .. (allowed == 1 and ':allowed' or ':limited'), 1)
+return {allowed, retry_after}
+"""
+
+
+def rate_limits():
+    return getattr(settings, "CHAT_RATE_LIMITS", {})
+
+
+def bucket_key(user_id, event):
+    return f"ratelimit:{event}:{user_id}"
+
+
+# Returns (allowed, retry_after_ms). Fails open: a Redis outage must not
+# take the chat down with it.
+async def check_rate_limit(user_id, event):
+    limit = rate_limits().get(event)
+    if not limit:
+        return True, 0
+    rate, burst = limit["RATE"], limit["BURST"]
+    try:
+        allowed, retry_after = await get_async_script(TOKEN_BUCKET_SCRIPT)(
+            keys=[bucket_key(user_id, event), STATS_KEY],
+            args=[rate, burst, event, math.ceil(burst / rate) + 1]
+        )
+        return bool(allowed), int(retry_after)
+    except Exception as e:
+        logger.error(f"Error checking rate limit for {event}: {e}")
+        return True, 0
+
+
+def get_rate_limit_stats():
+    client = get_redis()
+    if not client:
+        return {}
+    return {
+        (field.decode() if isinstance(field, bytes) else field): int(count)
+        for field, count in client.hgetall(STATS_KEY).items()
+    }
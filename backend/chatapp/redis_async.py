@@ -0,0 +1,28 @@
+import asyncio
+import weakref
+import redis.asyncio as aioredis
+from django.conf import settings
+
+# redis.asyncio clients are bound to the loop that created them, so there is
+# one client (and connection pool) per event loop, created on first use.
+_clients = weakref.WeakKeyDictionary()
+_scripts = weakref.WeakKeyDictionary()
+
+
+def get_async_redis():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = aioredis.from_url(settings.CHAT_REDIS_URL)
+        _clients[loop] = client
+    return client
+
+
+def get_async_script(source):
+    loop = asyncio.get_running_loop()
+    scripts = _scripts.setdefault(loop, {})
+    script = scripts.get(source)
+    if script is None:
+        script = get_async_redis().register_script(source)
+        scripts[source] = script
+    return script
@@ -1,20 +1,23 @@
 from rest_framework import serializers
 from .models import Conversation, Message, Notification
 from users.serializers import UserSerializer
+from .context import display_name
+from .services import is_message_read, read_watermarks
 
 class MessageSerializer(serializers.ModelSerializer):
     sender_name = serializers.SerializerMethodField()
     sender_email = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
         fields = [
-            'mid', 'conversation', 'sender', 'sender_name', 
+            'mid', 'seq', 'conversation', 'sender', 'sender_name', 
             'sender_email', 'message', 'image', 'message_type',
             'timestamp', 'is_read'
         ]
         read_only_fields = [
-            'mid', 'conversation', 'timestamp', 
+            'mid', 'seq', 'conversation', 'timestamp', 
             'sender_name', 'sender_email'
         ]
     
@@ -27,10 +30,17 @@ class MessageSerializer(serializers.ModelSerializer):
     def get_sender_email(self, obj):
         return obj.sender.email if obj.sender else ""
 
+    def get_is_read(self, obj):
+        watermarks = self.context.get('read_watermarks')
+        if watermarks is None:
+            return obj.is_read
+        return is_message_read(obj, self.context['conversation'], watermarks)
+
 
 class LastMessageSerializer(serializers.ModelSerializer):
     sender_name = serializers.SerializerMethodField()
     sender_id = serializers.IntegerField(source='sender.id', read_only=True)
+    is_read = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
@@ -45,6 +55,15 @@ class LastMessageSerializer(serializers.ModelSerializer):
             return name if name else obj.sender.email
         return "Unknown"
 
+    # Inside a conversation listing the counters answer this without a
+    # query: the newest message is read once its reader's side is at zero.
+    def get_is_read(self, obj):
+        conversation = self.context.get('conversation')
+        if conversation is not None:
+            field = "staff_unread_count" if obj.sender_id == conversation.user_id else "user_unread_count"
+            return getattr(conversation, field) == 0
+        return is_message_read(obj, obj.conversation, read_watermarks(obj.conversation))
+
 
 class ConversationSerializer(serializers.ModelSerializer):
     user_details = UserSerializer(source='user', read_only=True)
@@ -56,22 +75,43 @@ class ConversationSerializer(serializers.ModelSerializer):
         model = Conversation
         fields = [
             'cid', 'user', 'user_details', 'slug', 
-            'created_at', 'last_message', 'unread_count', 'is_online'
+            'created_at', 'last_message', 'last_message_at',
+            'last_message_preview', 'unread_count', 'is_online'
         ]
         read_only_fields = [
-            'cid', 'created_at', 'slug', 'last_message', 
-            'unread_count', 'is_online'
+            'cid', 'created_at', 'slug', 'last_message', 'last_message_at',
+            'last_message_preview', 'unread_count', 'is_online'
         ]
     
+    # Callers listing conversations select_related('last_message__sender').
     def get_last_message(self, obj):
-        last_msg = Message.objects.filter(
-            conversation=obj
-        ).select_related('sender').order_by('-timestamp').first()
-        
-        if last_msg:
-            return LastMessageSerializer(last_msg).data
-        return None
+        if obj.last_message_id is None:
+            return None
+        return LastMessageSerializer(obj.last_message, context={'conversation': obj}).data
     
+# Row of the staff inbox: only denormalized Conversation columns and the
+# owner's name, so a page is one query without joins on messages.
+class InboxConversationSerializer(serializers.ModelSerializer):
+    user_name = serializers.SerializerMethodField()
+    user_email = serializers.EmailField(source='user.email', read_only=True)
+    unread_count = serializers.IntegerField(source='staff_unread_count', read_only=True)
+    is_online = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Conversation
+        fields = [
+            'cid', 'slug', 'user', 'user_name', 'user_email', 'last_message_id',
+            'last_message_at', 'last_message_preview', 'unread_count', 'is_online'
+        ]
+        read_only_fields = fields
+
+    def get_user_name(self, obj):
+        return display_name(obj.user)
+
+    def get_is_online(self, obj):
+        return str(obj.user_id) in self.context.get('online_ids', ())
+
+
 class NotificationSerializer(serializers.ModelSerializer):
 
     class Meta:
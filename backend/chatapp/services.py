@@ -0,0 +1,129 @@
+from collections import Counter, defaultdict
+from django.db import transaction
+from django.db.models import F
+from .models import Conversation, Message, ReadPointer
+from .outbox import message_events, record_events
+
+
+def save_messages(messages):
+    with transaction.atomic():
+        by_conversation = defaultdict(list)
+        for message in messages:
+            by_conversation[message.conversation.pk].append(message)
+
+        # Sequence numbers are reserved by the same UPDATE that bumps the
+        # unread counters. The row lock it takes is held until commit, so
+        # seqs are gap-free and in commit order within a conversation. Rows
+        # are locked in cid order so batches spanning the same conversations
+        # can't deadlock each other.
+        for cid in sorted(by_conversation):
+            batch = by_conversation[cid]
+            owner_id = batch[0].conversation.user_id
+            updates = {"last_seq": F("last_seq") + len(batch)}
+            unread = Counter(
+                "staff_unread_count" if message.sender_id == owner_id else "user_unread_count"
+                for message in batch
+            )
+            for field, count in unread.items():
+                updates[field] = F(field) + count
+            Conversation.objects.filter(cid=cid).update(**updates)
+            last_seq = Conversation.objects.filter(cid=cid).values_list("last_seq", flat=True).get()
+            for offset, message in enumerate(batch):
+                message.seq = last_seq - len(batch) + offset + 1
+
+        if len(messages) == 1:
+            # Write-behind preassigns mid, and a plain save() would try an
+            # UPDATE first.
+            messages[0].save(force_insert=True)
+        else:
+            Message.objects.bulk_create(messages)
+
+        # The row is still locked from the seq UPDATE, so the batch's last
+        # message is the conversation's newest.
+        for cid, batch in by_conversation.items():
+            Conversation.objects.filter(cid=cid).update(**last_message_fields(batch[-1]))
+
+        record_events(message_events(messages))
+    return messages
+
+
+def last_message_fields(message):
+    return {
+        "last_message": message,
+        "last_message_at": message.timestamp,
+        "last_message_preview": message.preview(),
+    }
+
+
+def resume_state(conversation, since, limit):
+    messages = list(
+        Message.objects.filter(conversation=conversation, seq__gt=since)
+        .select_related("sender")
+        .order_by("seq")[:limit]
+    )
+    last_seq = Conversation.objects.filter(cid=conversation.cid).values_list("last_seq", flat=True).first()
+    return messages, read_watermarks(conversation), last_seq or 0
+
+
+def has_unread(conversation, reader):
+    field = conversation.unread_field_for(reader)
+    count = Conversation.objects.filter(cid=conversation.cid).values_list(field, flat=True).first()
+    return bool(count)
+
+
+def read_side(conversation, user_id):
+    return "user" if user_id == conversation.user_id else "staff"
+
+
+# A side's watermark is the furthest any of its participants has read: the
+# owner for the "user" side, any staff member for the "staff" side.
+def read_watermarks(conversation):
+    watermarks = {"user": 0, "staff": 0}
+    pointers = ReadPointer.objects.filter(conversation=conversation).values_list("user_id", "last_read_seq")
+    for user_id, last_read_seq in pointers:
+        side = read_side(conversation, user_id)
+        watermarks[side] = max(watermarks[side], last_read_seq)
+    return watermarks
+
+
+def is_message_read(message, conversation, watermarks):
+    reader_side = "staff" if message.sender_id == conversation.user_id else "user"
+    return message.seq is not None and message.seq <= watermarks[reader_side]
+
+
+def unread_messages(conversation, reader):
+    watermark = read_watermarks(conversation)[read_side(conversation, reader.id)]
+    messages = Message.objects.filter(conversation=conversation, seq__gt=watermark)
+    if reader.id == conversation.user_id:
+        return messages.exclude(sender_id=conversation.user_id)
+    return messages.filter(sender_id=conversation.user_id)
+
+
+# save_messages reserves seqs and bumps the unread counters while holding
+# the conversation row lock, so under the same lock last_seq covers exactly
+# the messages the counter reset below clears.
+def mark_conversation_read(conversation, reader):
+    with transaction.atomic():
+        last_seq = (
+            Conversation.objects.select_for_update()
+            .filter(cid=conversation.cid)
+            .values_list("last_seq", flat=True)
+            .get()
+        )
+        if not last_seq:
+            return None
+        advanced = ReadPointer.objects.filter(
+            conversation=conversation,
+            user_id=reader.id,
+            last_read_seq__lt=last_seq
+        ).update(last_read_seq=last_seq)
+        if not advanced:
+            _, advanced = ReadPointer.objects.get_or_create(
+                conversation=conversation,
+                user_id=reader.id,
+                defaults={"last_read_seq": last_seq}
+            )
+        if not advanced:
+            return None
+        Conversation.objects.filter(cid=conversation.cid).update(**{conversation.unread_field_for(reader): 0})
+    return last_seq
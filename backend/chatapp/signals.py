@@ -0,0 +1,40 @@
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+from users.models import CustomUser
+from .context import invalidate_user_card, invalidate_user_context
+
+# What user cards and conversation contexts are built from. Other saves
+# (last_login on every login, password changes) must not make every socket
+# in the user's context groups reload.
+CONTEXT_FIELDS = ("first_name", "last_name", "email", "is_staff")
+
+
+def context_values(user):
+    return tuple(getattr(user, field) for field in CONTEXT_FIELDS)
+
+
+@receiver(pre_save, sender=CustomUser)
+def snapshot_chat_context(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or update_fields is not None:
+        return
+    instance._chat_context_before = (
+        CustomUser.objects.filter(pk=instance.pk).values_list(*CONTEXT_FIELDS).first()
+    )
+
+
+@receiver(post_save, sender=CustomUser)
+def refresh_chat_context(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        return
+    if update_fields is not None:
+        if not set(update_fields) & set(CONTEXT_FIELDS):
+            return
+    elif instance.__dict__.pop("_chat_context_before", None) == context_values(instance):
+        return
+
+    def invalidate():
+        invalidate_user_card(instance.id)
+        invalidate_user_context(instance.id)
+
+    transaction.on_commit(invalidate)
@@ -1,23 +1,24 @@
 from celery import shared_task
-from django.core.cache import cache
 from django.utils import timezone
 import logging
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from .notifications import (
+    ack_notification_buffers, buffer_notification, buffer_notifications_once, digest_text, digest_window,
+    drain_notification_buffers, release_notification_flush
+)
+from .presence import (
+    ConnectionCounter, ONLINE_USERS, ONLINE_STAFF, clear_presence, get_connection_count, get_redis, presence_key
+)
 
 logger = logging.getLogger(__name__)
 
-try:
-    redis_instance = cache.client.get_client(write=True)
-except Exception as e:
-    logger.error(f"Redis connection error: {e}")
-    redis_instance = None
-
 
 @shared_task
 def cleanup_stale_connections():
     try:
+        redis_instance = get_redis()
         if not redis_instance:
             logger.warning("Redis instance not available for cleanup")
             return
@@ -25,25 +26,19 @@ def cleanup_stale_connections():
         cleaned_users = 0
         cleaned_staff = 0
 
-        online_users = redis_instance.smembers("online_users")
+        online_users = redis_instance.smembers(ONLINE_USERS)
         for user_id_bytes in online_users:
             user_id = user_id_bytes.decode() if isinstance(user_id_bytes, bytes) else str(user_id_bytes)
-            connection_key = f"user:{user_id}:connections"
-            
-            if not cache.get(connection_key):
-                redis_instance.srem("online_users", user_id)
-                cache.delete(f"user:{user_id}:status")
+
+            if not get_connection_count(user_id) and clear_presence(user_id, only_stale=True):
                 cleaned_users += 1
                 logger.info(f"Cleaned stale connection for user {user_id}")
 
-        online_staff = redis_instance.smembers("online_staff")
+        online_staff = redis_instance.smembers(ONLINE_STAFF)
         for staff_id_bytes in online_staff:
             staff_id = staff_id_bytes.decode() if isinstance(staff_id_bytes, bytes) else str(staff_id_bytes)
-            connection_key = f"user:{staff_id}:connections"
-            
-            if not cache.get(connection_key):
-                redis_instance.srem("online_staff", staff_id)
-                cache.delete(f"user:{staff_id}:status")
+
+            if not get_connection_count(staff_id) and clear_presence(staff_id, is_staff=True, only_stale=True):
                 cleaned_staff += 1
                 logger.info(f"Cleaned stale connection for staff {staff_id}")
 
@@ -64,26 +59,23 @@ def cleanup_stale_connections():
 @shared_task
 def heartbeat_checker():
     try:
+        redis_instance = get_redis()
         if not redis_instance:
             return
         current_time = timezone.now().timestamp()
-        timeout_threshold = 30
+        timeout_threshold = ConnectionCounter.TTL
 
-        for online_set in ["online_users", "online_staff"]:
+        for online_set in [ONLINE_USERS, ONLINE_STAFF]:
             online_ids = redis_instance.smembers(online_set)
             
             for user_id_bytes in online_ids:
                 user_id = user_id_bytes.decode() if isinstance(user_id_bytes, bytes) else str(user_id_bytes)
-                heartbeat_key = f"user:{user_id}:last_heartbeat"
-                connection_key = f"user:{user_id}:connections"
-                
-                last_heartbeat = cache.get(heartbeat_key)
-                
-                if last_heartbeat is None or (current_time - last_heartbeat) > timeout_threshold:
-                    if not cache.get(connection_key):
-                        redis_instance.srem(online_set, user_id)
-                        cache.delete(f"user:{user_id}:status")
-                        cache.delete(heartbeat_key)
+                last_heartbeat = redis_instance.hget(presence_key(user_id), "hb")
+
+                if last_heartbeat is None or (current_time - float(last_heartbeat)) > timeout_threshold:
+                    if not get_connection_count(user_id) and clear_presence(
+                        user_id, is_staff=(online_set == ONLINE_STAFF), only_stale=True
+                    ):
                         logger.info(f"Marked user {user_id} as offline due to heartbeat timeout")
 
     except Exception as e:
@@ -91,18 +83,14 @@ def heartbeat_checker():
 
 
 @shared_task
-def force_offline_user(user_id, is_staff=False):
+def force_offline_user(user_id, is_staff=False, only_stale=False):
     try:
-        if not redis_instance:
+        if not get_redis():
+            return False
+
+        if not clear_presence(str(user_id), is_staff=is_staff, only_stale=only_stale):
             return False
 
-        user_id = str(user_id)
-        online_set = "online_staff" if is_staff else "online_users"
-        redis_instance.srem(online_set, user_id)
-        cache.delete(f"user:{user_id}:connections")
-        cache.delete(f"user:{user_id}:status")
-        cache.delete(f"user:{user_id}:last_heartbeat")
-        
         logger.info(f"Forced user {user_id} offline")
         return True
 
@@ -114,49 +102,110 @@ def force_offline_user(user_id, is_staff=False):
 @shared_task
 def force_offline_stale_users():
     try:
+        redis_instance = get_redis()
         # Users
-        online_users = redis_instance.smembers("online_users")
+        online_users = redis_instance.smembers(ONLINE_USERS)
         for user_id_bytes in online_users:
             user_id = user_id_bytes.decode() if isinstance(user_id_bytes, bytes) else str(user_id_bytes)
-            connection_key = f"user:{user_id}:connections"
-            
-            if not cache.get(connection_key):  
-                force_offline_user.delay(user_id)
+
+            if not get_connection_count(user_id):
+                force_offline_user.delay(user_id, only_stale=True)
     
-        online_staff = redis_instance.smembers("online_staff")
+        online_staff = redis_instance.smembers(ONLINE_STAFF)
         for staff_id_bytes in online_staff:
             staff_id = staff_id_bytes.decode() if isinstance(staff_id_bytes, bytes) else str(staff_id_bytes)
-            connection_key = f"user:{staff_id}:connections"
-            
-            if not cache.get(connection_key): 
-                force_offline_user.delay(staff_id, is_staff=True)
+
+            if not get_connection_count(staff_id):
+                force_offline_user.delay(staff_id, is_staff=True, only_stale=True)
 
     except Exception as e:
         logger.error(f"Error in force_offline_stale_users: {e}", exc_info=True)
 
 
 @shared_task
-def notify_recipent_message(message, sender, recipient,  type):
+def notify_recipent_message(message, sender, recipient,  type, message_id=None):
+    try:
+        # Buffered per recipient and written as one digest per window. With
+        # a message id the entry is queued once even if the task is sent or
+        # delivered twice (retries, redelivery after a worker crash).
+        entry = {"sender": sender, "type": type, "message": message}
+        if message_id is not None:
+            flush = buffer_notifications_once([(message_id, recipient, entry)])
+        else:
+            flush = buffer_notification(recipient, entry)
+        if flush:
+            flush_notification_digests.apply_async(countdown=digest_window())
+    except Exception as e:
+        logger.error(f"Exception in sending a notification: {e}")
+
+
+@shared_task
+def drain_outbox():
+    try:
+        from . import outbox
+        # Cleared before claiming so events committed from here on schedule
+        # the next drain instead of waiting for the beat backstop.
+        get_redis().delete(outbox.DRAIN_SCHEDULED)
+        max_batches = outbox.outbox_config().get("MAX_BATCHES", 20)
+        drained = 0
+        flush = False
+        for _ in range(max_batches):
+            events = outbox.claim_batch()
+            if not events:
+                break
+            completed, batch_flush = outbox.handle_batch(events)
+            flush = batch_flush or flush
+            drained += completed
+            if completed < len(events):
+                # Released events wait out their retry delay.
+                break
+        if flush:
+            flush_notification_digests.apply_async(countdown=digest_window())
+        return drained
+    except Exception as e:
+        logger.error(f"Exception in draining the outbox: {e}", exc_info=True)
+
+
+@shared_task
+def flush_notification_digests():
     try:
         from .models import Notification, CustomUser
-        if type == 'message':
-            msg = f'{sender} has sent "{message}".'
-        if type == "image":
-            msg = f'{sender} has sent an image'
-        user = CustomUser.objects.filter(id=recipient).first()
-        Notification.objects.create(
-                user=user,
-                notification=msg
-            )
-        
+        drained = drain_notification_buffers()
+        if drained is None:
+            return 0
+        buffers, read = drained
+        try:
+            existing = {
+                str(user_id) for user_id in
+                CustomUser.objects.filter(id__in=list(buffers)).values_list("id", flat=True)
+            }
+            digests = {
+                recipient_id: digest_text(entries)
+                for recipient_id, entries in buffers.items()
+                if recipient_id in existing
+            }
+            Notification.objects.bulk_create([
+                Notification(user_id=recipient_id, notification=text)
+                for recipient_id, text in digests.items()
+            ])
+            # Written: only now take the entries out of the buffers.
+            ack_notification_buffers(read)
+        finally:
+            release_notification_flush()
+        if not digests:
+            return 0
+
         channel_layer = get_channel_layer()
-        if channel_layer:  
-            async_to_sync(channel_layer.group_send)(
-                f"user_{recipient}",  
-                {
-                    "type": "notify", 
-                    "notification": msg
-                }
-            )    
+        if channel_layer:
+            for recipient_id, text in digests.items():
+                async_to_sync(channel_layer.group_send)(
+                    f"user_{recipient_id}",
+                    {
+                        "type": "notify",
+                        "notification": text
+                    }
+                )
+        logger.debug(f"Flushed notification digests for {len(digests)} recipients")
+        return len(digests)
     except Exception as e:
-        logger.error(f"Exception in sending a notification: {e}")
+        logger.error(f"Exception in flushing notification digests: {e}", exc_info=True)
@@ -1,3 +1,883 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import uuid
+from collections import deque
+from datetime import timedelta
+from functools import partial
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from users.models import CustomUser
+from . import outbox
+from .backpressure import WritePressure, attach_write_pressure
+from .batcher import MessageBatcher, reserve_message_ids
+from .codec import JSONCodec, expand, negotiate
+from .consumers import ChatConsumer, ConversationSession
+from .models import Conversation, Message, Notification, OutboxEvent
+from .notifications import (
+    FLUSH_LOCK, PENDING_RECIPIENTS, buffer_key, buffer_notification, buffer_notifications_once,
+    drain_notification_buffers, notification_key
+)
+from .pagination import StaffInboxPagination
+from .presence import (
+    ONLINE_USERS, ConnectionCounter, clear_presence, get_redis, join_room, leave_room, presence_key,
+    room_presence_key,
+)
+from .pubsub import PreparedFeed, PubSubHub, Subscription
+from .ratelimit import bucket_key, check_rate_limit, get_rate_limit_stats
+from .redis_async import get_async_redis
+from .services import mark_conversation_read, save_messages, unread_messages
+from .tasks import drain_outbox, flush_notification_digests
 
-# Create your tests here.
+
+def redis_available():
+    try:
+        return bool(get_redis().ping())
+    except Exception:
+        return False
+
+
+# An owner, a staff member and the owner's conversation, created once per
+# class and shared by the tests that exercise a single conversation.
+class ChatFixtures:
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user(
+            email="owner@example.com", password="secret", first_name="Ada", last_name="Owner"
+        )
+        cls.staff = CustomUser.objects.create_user(
+            email="staff@example.com", password="secret", first_name="Sam", last_name="Staff", is_staff=True
+        )
+        cls.conversation = Conversation.objects.create(user=cls.owner)
+
+
+# Plans for the hot read paths. A full scan of a chat table (SQLite "SCAN t"
+# without "USING", Postgres "Seq Scan on t") means an index went missing or
+# a query stopped matching one.
+class QueryPlanTests(ChatFixtures, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        save_messages([
+            Message(
+                conversation=cls.conversation,
+                sender=cls.owner if i % 2 else cls.staff,
+                message=f"message {i}"
+            )
+            for i in range(20)
+        ])
+        Notification.objects.bulk_create([
+            Notification(user=cls.owner, notification=f"notification {i}", is_read=bool(i % 2))
+            for i in range(10)
+        ])
+
+    def assertNoFullScan(self, queryset, table):
+        plan = queryset.explain()
+        if connection.vendor == "postgresql":
+            self.assertNotIn(f"Seq Scan on {table}", plan, plan)
+        else:
+            self.assertIsNone(re.search(rf"\bSCAN {table}\b(?! USING)", plan), plan)
+        return plan
+
+    def test_history_uses_index_for_filter_and_order(self):
+        queryset = Message.objects.filter(conversation=self.conversation).order_by("-timestamp")[:36]
+        plan = self.assertNoFullScan(queryset, "chatapp_message")
+        if connection.vendor == "sqlite":
+            self.assertNotIn("TEMP B-TREE", plan, plan)
+
+    def test_unread_for_owner_uses_index(self):
+        queryset = unread_messages(self.conversation, self.owner).order_by("seq")
+        self.assertNoFullScan(queryset, "chatapp_message")
+
+    def test_unread_for_staff_uses_index(self):
+        queryset = unread_messages(self.conversation, self.staff).order_by("seq")
+        self.assertNoFullScan(queryset, "chatapp_message")
+
+    def test_resume_uses_index(self):
+        queryset = Message.objects.filter(conversation=self.conversation, seq__gt=5).order_by("seq")
+        self.assertNoFullScan(queryset, "chatapp_message")
+
+    def test_notifications_use_index(self):
+        queryset = Notification.objects.filter(user=self.owner, is_read=False).order_by("-created_at")
+        self.assertNoFullScan(queryset, "chatapp_notification")
+
+    def test_staff_inbox_uses_index(self):
+        queryset = Conversation.objects.filter(last_message_at__isnull=False).order_by("-last_message_at", "-cid")[:50]
+        self.assertNoFullScan(queryset, "chatapp_conversation")
+
+    def test_total_unread_uses_partial_index(self):
+        queryset = Conversation.objects.filter(staff_unread_count__gt=0).values("staff_unread_count")
+        self.assertNoFullScan(queryset, "chatapp_conversation")
+
+
+class ConversationSummaryTests(ChatFixtures, TestCase):
+
+    def test_save_messages_updates_summary_and_counters(self):
+        save_messages([Message(conversation=self.conversation, sender=self.owner, message="hello")])
+        last = save_messages([
+            Message(conversation=self.conversation, sender=self.staff, message="hi"),
+            Message(conversation=self.conversation, sender=self.staff, image="https://example.com/a.png", message_type="IMAGE"),
+        ])[-1]
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, last.mid)
+        self.assertEqual(self.conversation.last_message_at, last.timestamp)
+        self.assertEqual(self.conversation.last_message_preview, "Image")
+        self.assertEqual(self.conversation.staff_unread_count, 1)
+        self.assertEqual(self.conversation.user_unread_count, 2)
+
+    def test_save_messages_locks_conversations_in_cid_order(self):
+        other_owner = CustomUser.objects.create_user(email="other@example.com", password="secret")
+        other = Conversation.objects.create(user=other_owner)
+        first, second = sorted([self.conversation, other], key=lambda conversation: conversation.cid)
+        with CaptureQueriesContext(connection) as queries:
+            save_messages([
+                Message(conversation=second, sender=self.staff, message="b"),
+                Message(conversation=first, sender=self.staff, message="a"),
+            ])
+        locked = [
+            conversation.cid for query in queries.captured_queries
+            for conversation in (first, second)
+            if query["sql"].startswith('UPDATE "chatapp_conversation" SET "last_seq"')
+            and conversation.cid.hex in query["sql"]
+        ]
+        self.assertEqual(locked, [first.cid, second.cid])
+
+    def test_rebuild_matches_live_summary(self):
+        save_messages([
+            Message(conversation=self.conversation, sender=self.owner, message="x" * 500),
+            Message(conversation=self.conversation, sender=self.staff, message="reply"),
+        ])
+        self.conversation.refresh_from_db()
+        live = (
+            self.conversation.last_message_id, self.conversation.last_message_preview,
+            self.conversation.user_unread_count, self.conversation.staff_unread_count
+        )
+
+        Conversation.objects.filter(cid=self.conversation.cid).update(
+            last_message=None, last_message_at=None, last_message_preview="",
+            user_unread_count=0, staff_unread_count=0
+        )
+        call_command("rebuild_conversation_summaries", stdout=StringIO())
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(live, (
+            self.conversation.last_message_id, self.conversation.last_message_preview,
+            self.conversation.user_unread_count, self.conversation.staff_unread_count
+        ))
+
+
+class StaffInboxTests(TestCase):
+
+    def setUp(self):
+        self.staff = CustomUser.objects.create_user(
+            email="staff@example.com", password="secret", first_name="Sam", last_name="Staff", is_staff=True
+        )
+        self.owners = []
+        self.conversations = []
+        for i in range(5):
+            owner = CustomUser.objects.create_user(email=f"owner{i}@example.com", password="secret")
+            conversation = Conversation.objects.create(user=owner)
+            save_messages([Message(conversation=conversation, sender=owner, message=f"hello {i}")])
+            self.owners.append(owner)
+            self.conversations.append(conversation)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def fetch(self, url=None, online_ids=(), **params):
+        statuses = lambda user_ids: {
+            str(user_id): "online" if str(user_id) in online_ids else "offline" for user_id in user_ids
+        }
+        with mock.patch("chatapp.views.get_statuses", side_effect=statuses), \
+                mock.patch("chatapp.views.get_online_members", return_value=list(online_ids)):
+            response = self.client.get(url or reverse("staff-inbox"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def cids(self, data):
+        return [str(row["cid"]) for row in data["results"]]
+
+    def test_newest_first_with_total_unread(self):
+        data = self.fetch()
+        self.assertEqual(self.cids(data), [str(c.cid) for c in reversed(self.conversations)])
+        self.assertEqual(data["total_unread"], 5)
+
+    def test_unread_filter(self):
+        mark_conversation_read(self.conversations[0], self.staff)
+        data = self.fetch(unread="true")
+        self.assertNotIn(str(self.conversations[0].cid), self.cids(data))
+        self.assertEqual(len(data["results"]), 4)
+        self.assertEqual(data["total_unread"], 4)
+
+    def test_assigned_filter(self):
+        mark_conversation_read(self.conversations[1], self.staff)
+        data = self.fetch(assigned="me")
+        self.assertEqual(self.cids(data), [str(self.conversations[1].cid)])
+
+    def test_online_filter(self):
+        online = {str(self.owners[1].id), str(self.owners[3].id)}
+        data = self.fetch(online_ids=online, online="true")
+        self.assertEqual(self.cids(data), [str(self.conversations[3].cid), str(self.conversations[1].cid)])
+        self.assertTrue(all(row["is_online"] for row in data["results"]))
+
+    def test_cursor_pages_cover_every_conversation_once(self):
+        seen = []
+        url = None
+        with mock.patch.object(StaffInboxPagination, "page_size", 2):
+            while True:
+                data = self.fetch(url)
+                seen.extend(self.cids(data))
+                url = data["next"]
+                if not url:
+                    break
+        self.assertEqual(seen, [str(c.cid) for c in reversed(self.conversations)])
+
+    def test_online_filter_fills_every_page(self):
+        online = {str(self.owners[i].id) for i in (0, 2, 4)}
+        pages = []
+        url = None
+        with mock.patch.object(StaffInboxPagination, "page_size", 2):
+            while True:
+                # The next link carries ?online=true forward.
+                data = self.fetch(url, online_ids=online, **({} if url else {"online": "true"}))
+                pages.append(self.cids(data))
+                url = data["next"]
+                if not url:
+                    break
+        self.assertEqual(pages, [
+            [str(self.conversations[4].cid), str(self.conversations[2].cid)],
+            [str(self.conversations[0].cid)]
+        ])
+
+
+class ReadWatermarkTests(ChatFixtures, TestCase):
+
+    def test_mark_read_moves_watermark_to_last_seq(self):
+        save_messages([
+            Message(conversation=self.conversation, sender=self.owner, message="one"),
+            Message(conversation=self.conversation, sender=self.owner, message="two"),
+        ])
+        self.assertEqual(mark_conversation_read(self.conversation, self.staff), 2)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.staff_unread_count, 0)
+        self.assertFalse(unread_messages(self.conversation, self.staff).exists())
+        self.assertIsNone(mark_conversation_read(self.conversation, self.staff))
+
+    # Write-behind hands out mids from per-process blocks, so a message can
+    # commit after one with a higher mid. It must still count as unread.
+    def test_lower_mid_committed_later_stays_unread(self):
+        save_messages([Message(mid=101, conversation=self.conversation, sender=self.owner, message="first")])
+        mark_conversation_read(self.conversation, self.staff)
+        save_messages([Message(mid=2, conversation=self.conversation, sender=self.owner, message="second")])
+
+        self.assertEqual(list(unread_messages(self.conversation, self.staff).values_list("mid", flat=True)), [2])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.staff_unread_count, 1)
+
+
+@override_settings(CHAT_OUTBOX={"BATCH_SIZE": 10, "MAX_BATCHES": 5, "LEASE_SECONDS": 60, "MAX_ATTEMPTS": 3, "RETRY_DELAY": 10})
+class OutboxTests(TestCase):
+
+    def record(self, *names):
+        OutboxEvent.objects.bulk_create([
+            OutboxEvent(kind=OutboxEvent.MESSAGE_CREATED, payload={"name": name}) for name in names
+        ])
+
+    def test_claim_batch_leases_each_event_once(self):
+        self.record("a", "b", "c")
+        self.assertEqual([event.payload["name"] for event in outbox.claim_batch()], ["a", "b", "c"])
+        self.assertEqual(outbox.claim_batch(), [])
+
+    def test_expired_lease_is_claimable_again(self):
+        self.record("a")
+        outbox.claim_batch()
+        OutboxEvent.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(outbox.claim_batch()), 1)
+
+    def test_release_retries_after_delay_then_dead_letters(self):
+        self.record("a")
+        outbox.release(outbox.claim_batch())
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertIsNone(event.claim_token)
+        self.assertGreater(event.claimed_until, timezone.now())
+        self.assertEqual(outbox.claim_batch(), [])
+
+        OutboxEvent.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(outbox.claim_batch()), 1)
+
+        OutboxEvent.objects.update(attempts=3, claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(outbox.claim_batch(), [])
+
+    @mock.patch("chatapp.tasks.get_redis")
+    def test_drain_completes_processed_events(self, get_redis):
+        self.record("a", "b")
+        with mock.patch.object(outbox, "process", return_value=False) as process:
+            self.assertEqual(drain_outbox(), 2)
+        process.assert_called_once()
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    @mock.patch("chatapp.tasks.get_redis")
+    def test_drain_isolates_poison_event(self, get_redis):
+        self.record("a", "poison", "b")
+
+        def process(events):
+            if any(event.payload["name"] == "poison" for event in events):
+                raise ValueError("bad payload")
+            return False
+
+        with mock.patch.object(outbox, "process", side_effect=process), self.assertLogs("chatapp.outbox", "ERROR"):
+            self.assertEqual(drain_outbox(), 2)
+        poison = OutboxEvent.objects.get()
+        self.assertEqual(poison.payload["name"], "poison")
+        self.assertEqual(poison.attempts, 1)
+
+
+@skipUnless(redis_available(), "requires Redis")
+class NotificationBufferTests(TestCase):
+
+    def setUp(self):
+        get_redis().delete(notification_key("test-1"), buffer_key("test-recipient"))
+
+    def test_buffers_each_message_once(self):
+        entry = {"sender": "Ada", "type": "message", "message": "hi"}
+        buffer_notifications_once([("test-1", "test-recipient", entry)])
+        buffer_notifications_once([("test-1", "test-recipient", entry)])
+        self.assertEqual(get_redis().llen(buffer_key("test-recipient")), 1)
+
+
+@skipUnless(redis_available(), "requires Redis")
+class NotificationFlushTests(TestCase):
+
+    def setUp(self):
+        self.recipient = CustomUser.objects.create_user(email="recipient@example.com", password="secret")
+        get_redis().delete(buffer_key(self.recipient.id), PENDING_RECIPIENTS, FLUSH_LOCK)
+        buffer_notification(self.recipient.id, {"sender": "Ada", "type": "message", "message": "hi"})
+
+    def flush(self):
+        with mock.patch("chatapp.tasks.get_channel_layer", return_value=None):
+            return flush_notification_digests()
+
+    def test_failed_write_keeps_entries_buffered(self):
+        with mock.patch("chatapp.models.Notification.objects.bulk_create", side_effect=RuntimeError("database is locked")), \
+                self.assertLogs("chatapp.tasks", "ERROR"):
+            self.flush()
+        self.assertEqual(get_redis().llen(buffer_key(self.recipient.id)), 1)
+        self.assertTrue(get_redis().sismember(PENDING_RECIPIENTS, str(self.recipient.id)))
+
+        self.assertEqual(self.flush(), 1)
+        self.assertEqual(Notification.objects.filter(user=self.recipient).count(), 1)
+        self.assertEqual(get_redis().llen(buffer_key(self.recipient.id)), 0)
+        self.assertFalse(get_redis().sismember(PENDING_RECIPIENTS, str(self.recipient.id)))
+
+    def test_entries_buffered_during_flush_stay_queued(self):
+        drain = drain_notification_buffers
+
+        def drain_then_buffer():
+            drained = drain()
+            buffer_notification(self.recipient.id, {"sender": "Ada", "type": "message", "message": "again"})
+            return drained
+
+        with mock.patch("chatapp.tasks.drain_notification_buffers", side_effect=drain_then_buffer):
+            self.assertEqual(self.flush(), 1)
+        self.assertEqual(get_redis().llen(buffer_key(self.recipient.id)), 1)
+        self.assertTrue(get_redis().sismember(PENDING_RECIPIENTS, str(self.recipient.id)))
+
+    def test_concurrent_flush_leaves_entries_to_lock_holder(self):
+        get_redis().set(FLUSH_LOCK, 1)
+        self.assertEqual(self.flush(), 0)
+        self.assertEqual(get_redis().llen(buffer_key(self.recipient.id)), 1)
+        self.assertTrue(get_redis().exists(FLUSH_LOCK))
+        get_redis().delete(FLUSH_LOCK)
+
+
+@skipUnless(redis_available(), "requires Redis")
+class PresenceScriptTests(SimpleTestCase):
+    user_id = "presence-test-1"
+    cid = "presence-test-room"
+
+    def setUp(self):
+        get_redis().delete(presence_key(self.user_id), room_presence_key(self.cid))
+        get_redis().srem(ONLINE_USERS, self.user_id)
+
+    tearDown = setUp
+
+    def run_async(self, *calls):
+        async def scenario():
+            try:
+                return [await call() for call in calls]
+            finally:
+                await get_async_redis().aclose()
+
+        return asyncio.run(scenario())
+
+    def presence(self):
+        return {k.decode(): v.decode() for k, v in get_redis().hgetall(presence_key(self.user_id)).items()}
+
+    def test_connect_counts_sockets_and_joins_online_set(self):
+        counter = ConnectionCounter(self.user_id)
+        self.assertEqual(self.run_async(counter.increment, counter.increment), [1, 2])
+        presence = self.presence()
+        self.assertEqual((presence["conns"], presence["status"], presence["staff"]), ("2", "online", "0"))
+        self.assertTrue(get_redis().sismember(ONLINE_USERS, self.user_id))
+        self.assertLessEqual(get_redis().ttl(presence_key(self.user_id)), ConnectionCounter.TTL)
+
+    def test_connect_joins_rooms_in_the_same_round_trip(self):
+        counter = ConnectionCounter(self.user_id)
+        self.run_async(partial(counter.increment, rooms=[self.cid]))
+        self.assertEqual(get_redis().hget(room_presence_key(self.cid), self.user_id), b"1")
+
+    def test_disconnect_goes_offline_with_the_last_socket(self):
+        counter = ConnectionCounter(self.user_id)
+        results = self.run_async(counter.increment, counter.increment, counter.decrement, counter.decrement)
+        self.assertEqual(results[2:], [1, 0])
+        presence = self.presence()
+        self.assertEqual((presence["conns"], presence["status"]), ("0", "offline"))
+        self.assertNotIn("hb", presence)
+        self.assertFalse(get_redis().sismember(ONLINE_USERS, self.user_id))
+
+    def test_disconnect_without_connections_stays_at_zero(self):
+        self.assertEqual(self.run_async(ConnectionCounter(self.user_id).decrement), [0])
+        self.assertEqual(self.presence()["conns"], "0")
+
+    def test_heartbeat_refreshes_only_connected_users(self):
+        counter = ConnectionCounter(self.user_id)
+        self.run_async(counter.heartbeat)
+        self.assertFalse(get_redis().exists(presence_key(self.user_id)))
+        self.assertFalse(get_redis().sismember(ONLINE_USERS, self.user_id))
+
+        self.run_async(counter.increment)
+        get_redis().hset(presence_key(self.user_id), "hb", 0)
+        get_redis().srem(ONLINE_USERS, self.user_id)
+        self.run_async(counter.heartbeat)
+        self.assertNotEqual(self.presence()["hb"], "0")
+        self.assertTrue(get_redis().sismember(ONLINE_USERS, self.user_id))
+
+    def test_room_leave_removes_user_at_zero(self):
+        join, leave = partial(join_room, self.cid, self.user_id), partial(leave_room, self.cid, self.user_id)
+        self.assertEqual(self.run_async(join, join), [1, 2])
+        self.run_async(leave)
+        self.assertEqual(get_redis().hget(room_presence_key(self.cid), self.user_id), b"1")
+        self.run_async(leave)
+        self.assertFalse(get_redis().hexists(room_presence_key(self.cid), self.user_id))
+
+    def test_stale_clear_leaves_reconnected_user(self):
+        client = get_redis()
+        client.hset(presence_key(self.user_id), mapping={"conns": 1, "status": "online"})
+        client.sadd(ONLINE_USERS, self.user_id)
+        self.assertFalse(clear_presence(self.user_id, only_stale=True))
+        self.assertTrue(client.sismember(ONLINE_USERS, self.user_id))
+
+        client.hset(presence_key(self.user_id), "conns", 0)
+        self.assertTrue(clear_presence(self.user_id, only_stale=True))
+        self.assertFalse(client.sismember(ONLINE_USERS, self.user_id))
+        self.assertFalse(client.exists(presence_key(self.user_id)))
+
+
+@skipUnless(redis_available(), "requires Redis")
+@override_settings(CHAT_RATE_LIMITS={"chat_message": {"RATE": 1.0, "BURST": 2}})
+class RateLimitTests(SimpleTestCase):
+    user_id = "ratelimit-test-1"
+
+    def setUp(self):
+        get_redis().delete(bucket_key(self.user_id, "chat_message"))
+
+    tearDown = setUp
+
+    def check(self, times, event="chat_message"):
+        async def scenario():
+            try:
+                return [await check_rate_limit(self.user_id, event) for _ in range(times)]
+            finally:
+                await get_async_redis().aclose()
+
+        return asyncio.run(scenario())
+
+    def test_bucket_allows_burst_then_limits(self):
+        before = get_rate_limit_stats()
+        results = self.check(3)
+        self.assertEqual([allowed for allowed, _ in results], [True, True, False])
+        self.assertTrue(0 < results[-1][1] <= 1000)
+
+        stats = get_rate_limit_stats()
+        self.assertEqual(stats["chat_message:allowed"] - before.get("chat_message:allowed", 0), 2)
+        self.assertEqual(stats["chat_message:limited"] - before.get("chat_message:limited", 0), 1)
+
+    def test_bucket_refills_at_rate(self):
+        get_redis().hset(bucket_key(self.user_id, "chat_message"), mapping={"tokens": 0, "ts": get_redis().time()[0] - 1})
+        self.assertEqual([allowed for allowed, _ in self.check(2)], [True, False])
+
+    def test_unlimited_events_skip_redis(self):
+        with mock.patch("chatapp.ratelimit.get_async_script") as script:
+            self.assertEqual(self.check(1, event="typing"), [(True, 0)])
+        script.assert_not_called()
+
+
+class MessageIdReservationTests(ChatFixtures, TestCase):
+
+    def test_reserved_ids_are_unique_and_skipped_by_plain_inserts(self):
+        first = reserve_message_ids(5)
+        second = reserve_message_ids(5)
+        self.assertEqual(len(set(first + second)), 10)
+
+        message = Message.objects.create(conversation=self.conversation, sender=self.owner, message="plain")
+        self.assertGreater(message.mid, max(first + second))
+
+    def test_single_message_with_reserved_id_is_inserted_directly(self):
+        mid = reserve_message_ids(1)[0]
+        with CaptureQueriesContext(connection) as queries:
+            save_messages([Message(mid=mid, conversation=self.conversation, sender=self.owner, message="hi")])
+        self.assertFalse(any(query["sql"].startswith('UPDATE "chatapp_message"') for query in queries.captured_queries))
+        self.assertTrue(Message.objects.filter(mid=mid).exists())
+
+
+class MessageBatcherTests(SimpleTestCase):
+
+    def test_enqueue_failure_is_reported_to_sender(self):
+        async def scenario():
+            batcher = MessageBatcher(max_delay=0, durability="enqueue")
+            batcher.write = mock.AsyncMock(side_effect=RuntimeError("database is locked"))
+            reported = asyncio.Queue()
+
+            async def on_failure(message, error):
+                await reported.put((message, error))
+
+            message = Message(mid=7, message="hi")
+            self.assertIs(await batcher.submit(message, on_failure=on_failure), message)
+            result = await asyncio.wait_for(reported.get(), 1)
+            batcher.worker.cancel()
+            return message, result
+
+        with self.assertLogs("chatapp.batcher", "ERROR"):
+            message, (failed, error) = asyncio.run(scenario())
+        self.assertIs(failed, message)
+        self.assertIsInstance(error, RuntimeError)
+
+    def test_commit_failure_raises_to_caller(self):
+        async def scenario():
+            batcher = MessageBatcher(max_delay=0, durability="commit")
+            batcher.write = mock.AsyncMock(side_effect=RuntimeError("database is locked"))
+            try:
+                with self.assertRaises(RuntimeError):
+                    await asyncio.wait_for(batcher.submit(Message(message="hi")), 1)
+            finally:
+                batcher.worker.cancel()
+
+        with self.assertLogs("chatapp.batcher", "ERROR"):
+            asyncio.run(scenario())
+
+
+    def test_failed_batch_falls_back_to_single_writes(self):
+        async def write(messages):
+            if len(messages) > 1 or messages[0].message == "bad":
+                raise RuntimeError("CHECK constraint failed")
+
+        async def scenario():
+            batcher = MessageBatcher(max_delay=0.01, durability="commit")
+            batcher.write = mock.AsyncMock(side_effect=write)
+            try:
+                return await asyncio.gather(
+                    *(batcher.submit(Message(message=text)) for text in ("one", "bad", "two")),
+                    return_exceptions=True
+                )
+            finally:
+                batcher.worker.cancel()
+
+        with self.assertLogs("chatapp.batcher", "WARNING"):
+            one, bad, two = asyncio.run(scenario())
+        self.assertEqual((one.message, two.message), ("one", "two"))
+        self.assertIsInstance(bad, RuntimeError)
+
+@override_settings(CHAT_SEND_QUEUE={"MAX_FRAMES": 3})
+class SendQueueTests(SimpleTestCase):
+
+    def make_consumer(self):
+        consumer = ChatConsumer()
+        consumer.user = SimpleNamespace(id=1)
+        consumer.send_queue = deque()
+        consumer.send_ready = asyncio.Event()
+        consumer.delivered_seq = {}
+        consumer.sessions = {}
+        consumer.known_users = {}
+        consumer.write_pressure = WritePressure()
+        consumer.send = mock.AsyncMock()
+        consumer.close = mock.AsyncMock()
+        return consumer
+
+    def sent_types(self, consumer):
+        return [json.loads(call.kwargs["text_data"])["type"] for call in consumer.send.await_args_list]
+
+    def test_writer_waits_for_transport_to_drain(self):
+        async def scenario():
+            consumer = self.make_consumer()
+            consumer.write_pressure.pauseProducing()
+            await consumer.send_frame({"type": "chat_message", "message": "one"})
+            await consumer.send_frame({"type": "chat_message", "message": "two"})
+            await asyncio.sleep(0.01)
+            self.assertEqual(consumer.send.await_count, 0)
+
+            consumer.write_pressure.resumeProducing()
+            await asyncio.sleep(0.01)
+            consumer.writer.cancel()
+            return consumer
+
+        consumer = asyncio.run(scenario())
+        self.assertEqual(self.sent_types(consumer), ["chat_message", "chat_message"])
+
+    def test_full_queue_drops_ephemeral_frames_then_closes(self):
+        async def scenario():
+            consumer = self.make_consumer()
+            consumer.write_pressure.pauseProducing()
+            await consumer.send_frame({"type": "chat_message", "message": "one"})
+            await consumer.send_frame({"type": "chat_message", "message": "two"})
+            await consumer.send_frame({"type": "typing", "user_id": "2", "is_typing": True})
+
+            # Full: a new ephemeral frame is dropped, a message evicts the
+            # queued typing frame instead.
+            await consumer.send_frame({"type": "typing", "user_id": "3", "is_typing": True})
+            await consumer.send_frame({"type": "chat_message", "message": "three"})
+            self.assertEqual(
+                [frame["type"] for frame, _, _ in consumer.send_queue],
+                ["chat_message", "chat_message", "chat_message"]
+            )
+            consumer.close.assert_not_awaited()
+
+            # Only messages left: close with a resume hint.
+            await consumer.send_frame({"type": "chat_message", "message": "four"})
+            return consumer
+
+        with self.assertLogs("chatapp.consumers", "WARNING"):
+            consumer = asyncio.run(scenario())
+        self.assertTrue(consumer.overflowed)
+        self.assertEqual(self.sent_types(consumer), ["resume_required"])
+        consumer.close.assert_awaited_once_with(code=4008)
+
+    def test_attaches_to_daphne_protocol(self):
+        async def send(*args):
+            pass
+
+        protocol = SimpleNamespace(registerProducer=mock.Mock())
+        pressure = attach_write_pressure(partial(send, protocol))
+        protocol.registerProducer.assert_called_once_with(pressure, True)
+        self.assertIsNone(attach_write_pressure(send))
+
+
+class DirectoryRefreshTests(SimpleTestCase):
+
+    def make_consumer(self, known_users):
+        consumer = ChatConsumer()
+        consumer.user = SimpleNamespace(id=1)
+        consumer.sessions = {}
+        consumer.subprotocol, consumer.codec = negotiate(["chat.v2.json"])
+        consumer.known_users = dict(known_users)
+        consumer.get_user_cards = mock.AsyncMock(return_value=[
+            {"id": "2", "name": "Grace Hopper", "email": "grace@example.com", "is_staff": False}
+        ])
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    def test_resends_changed_directory_entry(self):
+        consumer = self.make_consumer({"2": {"id": "2", "name": "Grace", "email": "grace@example.com"}})
+        asyncio.run(consumer.context_invalidate({"user_id": "2"}))
+        frame = expand(consumer.codec.decode(consumer.send.await_args.kwargs["text_data"]))
+        self.assertEqual(frame, {
+            "type": "directory",
+            "users": [{"id": "2", "name": "Grace Hopper", "email": "grace@example.com"}]
+        })
+
+    def test_typing_then_message_sends_the_email(self):
+        consumer = self.make_consumer({})
+
+        async def scenario():
+            await consumer.deliver({"type": "typing", "user_id": "2", "sender_name": "Grace", "is_typing": True})
+            await consumer.deliver({
+                "type": "chat_message", "message": "hi", "sender": "2",
+                "sender_name": "Grace", "sender_email": "grace@example.com"
+            })
+            await consumer.deliver({"type": "typing", "user_id": "2", "sender_name": "Grace", "is_typing": False})
+
+        asyncio.run(scenario())
+        frames = [
+            expand(consumer.codec.decode(call.kwargs["text_data"]))
+            for call in consumer.send.await_args_list
+        ]
+        directories = [frame["users"] for frame in frames if frame["type"] == "directory"]
+        self.assertEqual(directories, [
+            [{"id": "2", "name": "Grace"}],
+            [{"id": "2", "name": "Grace", "email": "grace@example.com"}]
+        ])
+        self.assertEqual(
+            [frame["type"] for frame in frames],
+            ["directory", "typing", "directory", "chat_message", "typing"]
+        )
+
+    def test_skips_users_the_client_has_not_seen(self):
+        consumer = self.make_consumer({})
+        asyncio.run(consumer.context_invalidate({"user_id": "2"}))
+        consumer.send.assert_not_awaited()
+
+
+class SubscribeTests(SimpleTestCase):
+
+    def subscribe(self, room_count):
+        consumer = ChatConsumer()
+        consumer.user = SimpleNamespace(id=1, is_staff=True)
+        consumer.sessions = {}
+        consumer.add_group = mock.AsyncMock()
+        consumer.send_frame = mock.AsyncMock()
+        conversation = SimpleNamespace(
+            cid=uuid.uuid4(), user_id=2, staff_unread_count=0,
+            unread_field_for=lambda user: "staff_unread_count"
+        )
+        consumer.load_conversation = mock.AsyncMock(return_value=(conversation, None))
+
+        with mock.patch("chatapp.consumers.ConversationContext.resolve", return_value=SimpleNamespace(groups=[])), \
+                mock.patch("chatapp.consumers.get_pubsub_hub", return_value=mock.Mock(subscribe=mock.AsyncMock())), \
+                mock.patch("chatapp.consumers.join_room", mock.AsyncMock(return_value=room_count)), \
+                mock.patch.object(ConversationSession, "send_backlog", mock.AsyncMock()), \
+                mock.patch.object(ConversationSession, "announce_status", mock.AsyncMock()) as announce:
+            asyncio.run(consumer.subscribe(str(conversation.cid)))
+        return announce
+
+    def test_first_join_announces_online(self):
+        self.subscribe(room_count=1).assert_awaited_once_with("online")
+
+    def test_join_from_another_socket_stays_quiet(self):
+        self.subscribe(room_count=2).assert_not_awaited()
+
+
+@override_settings(CHAT_TYPING={"MIN_INTERVAL": 0.05, "EXPIRE": 0.2})
+class TypingThrottleTests(SimpleTestCase):
+
+    def sent(self, *steps):
+        consumer = SimpleNamespace(user=SimpleNamespace(id=1))
+        conversation = SimpleNamespace(
+            cid=uuid.uuid4(), staff_unread_count=0, unread_field_for=lambda user: "staff_unread_count"
+        )
+        session = ConversationSession(consumer, conversation)
+        session.context = SimpleNamespace(sender_name="Ada")
+        session.send_ephemeral = mock.AsyncMock()
+
+        async def scenario():
+            for step in steps:
+                if isinstance(step, bool):
+                    await session.handle_typing({"is_typing": step})
+                else:
+                    await asyncio.sleep(step)
+            session.cancel_typing_task("typing_flush")
+            session.cancel_typing_task("typing_expiry")
+
+        asyncio.run(scenario())
+        return [call.args[0]["is_typing"] for call in session.send_ephemeral.await_args_list]
+
+    def test_repeated_frames_collapse(self):
+        self.assertEqual(self.sent(True, True, True), [True])
+
+    def test_changes_inside_interval_are_deferred(self):
+        self.assertEqual(self.sent(True, False), [True])
+        self.assertEqual(self.sent(True, False, 0.1), [True, False])
+
+    def test_deferred_changes_coalesce(self):
+        self.assertEqual(self.sent(True, False, True, 0.1), [True])
+        self.assertEqual(self.sent(True, False, True, False, 0.1), [True, False])
+
+    def test_silence_expires_typing(self):
+        self.assertEqual(self.sent(True, 0.1), [True])
+        self.assertEqual(self.sent(True, 0.3), [True, False])
+
+    def test_frames_keep_typing_alive(self):
+        self.assertEqual(self.sent(True, 0.15, True, 0.15), [True])
+
+
+class ReceiveTests(SimpleTestCase):
+
+    def test_typing_frames_bypass_the_rate_limit(self):
+        consumer = ChatConsumer()
+        consumer.user = SimpleNamespace(id=1)
+        consumer.codec = JSONCodec()
+        consumer.subprotocol = None
+        consumer.multiplexed = False
+        session = mock.Mock(handle=mock.AsyncMock())
+        consumer.sessions = {"c1": session}
+        consumer.send_frame = mock.AsyncMock()
+
+        with mock.patch("chatapp.consumers.check_rate_limit", mock.AsyncMock(return_value=(False, 500))) as check:
+            asyncio.run(consumer.receive(text_data=json.dumps({"type": "typing", "is_typing": True})))
+        check.assert_not_awaited()
+        consumer.send_frame.assert_not_awaited()
+        session.handle.assert_awaited_once_with("typing", {"type": "typing", "is_typing": True})
+
+
+class PubSubDispatchTests(SimpleTestCase):
+
+    def test_prepares_once_and_slow_handler_does_not_block_others(self):
+        async def scenario():
+            hub = PubSubHub()
+            received = asyncio.Queue()
+            blocked = asyncio.Event()
+            prepare = mock.AsyncMock(side_effect=lambda event: {**event, "card": {"id": "1"}})
+
+            async def slow(event):
+                await blocked.wait()
+
+            async def fast(event):
+                await received.put(event)
+
+            subscriptions = hub.subscriptions["presence"] = {
+                slow: Subscription("presence", slow),
+                fast: Subscription("presence", fast),
+            }
+            hub.feeds["presence"] = PreparedFeed("presence", prepare, subscriptions)
+            hub.dispatch("presence", {"user_id": 1})
+            hub.dispatch("presence", {"user_id": 2})
+            events = [await asyncio.wait_for(received.get(), 1) for _ in range(2)]
+
+            for subscription in subscriptions.values():
+                subscription.close()
+            hub.feeds["presence"].close()
+            return events, prepare.await_count
+
+        events, prepared = asyncio.run(scenario())
+        self.assertEqual([event["user_id"] for event in events], [1, 2])
+        self.assertEqual(events[0]["card"], {"id": "1"})
+        self.assertEqual(prepared, 2)
+
+
+class ChatContextSignalTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email="owner@example.com", password="secret", first_name="Ada", last_name="Owner"
+        )
+
+    def saved(self, **kwargs):
+        with mock.patch("chatapp.signals.invalidate_user_context") as invalidate, \
+                mock.patch("chatapp.signals.invalidate_user_card"), \
+                mock.patch("users.signals.invalidate_cached_user"), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.user.save(**kwargs)
+        return invalidate.called
+
+    def test_login_does_not_invalidate_context(self):
+        self.user.last_login = timezone.now()
+        self.assertFalse(self.saved(update_fields=["last_login"]))
+
+    def test_unchanged_save_does_not_invalidate_context(self):
+        self.user.set_password("other")
+        self.assertFalse(self.saved())
+
+    def test_name_change_invalidates_context(self):
+        self.user.first_name = "Grace"
+        self.assertTrue(self.saved())
+        self.user.last_name = "Hopper"
+        self.assertTrue(self.saved(update_fields=["last_name"]))
@@ -1,17 +1,20 @@
 from rest_framework import status
 from rest_framework.response import Response
-from .serializers import MessageSerializer, ConversationSerializer, NotificationSerializer
-from .models import Message, Conversation, Notification
+from .serializers import MessageSerializer, ConversationSerializer, InboxConversationSerializer, NotificationSerializer
+from .models import Message, Conversation, Notification, ReadPointer
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
-from django.db.models import Q, Exists, OuterRef, Max, Count, Prefetch
-from .pagination import MessageInfiniteScrollPagination
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from django.db.models import Q, Exists, OuterRef, Sum
+from .pagination import MessageInfiniteScrollPagination, StaffInboxPagination, UnreadReplayPagination
 from users.serializers import UserSerializer
 from django.http import HttpResponse
-from django.core.cache import cache
 from django.db import transaction
 from rest_framework.parsers import MultiPartParser, FormParser
 from .cloud import B2FileManager
+from . import metrics
+from .ratelimit import get_rate_limit_stats
+from .presence import get_online_members, get_statuses, online_set_name
+from .services import read_watermarks, unread_messages
 from django.shortcuts import get_object_or_404
 from django.http import Http404
 
@@ -21,34 +24,28 @@ class ConversationView(APIView):
     def get(self, request):
         if request.user.is_staff:
             conversations = Conversation.objects.filter(
-                Exists(Message.objects.filter(conversation=OuterRef('pk')))
-            ).select_related('user').annotate(
-                last_message_time=Max('messages__timestamp'),
-                unread_count=Count(
-                    'messages',
-                    filter=Q(messages__is_read=False) & ~Q(messages__sender=request.user)
-                )
-            ).order_by('-last_message_time') 
+                last_message_at__isnull=False
+            ).select_related('user', 'last_message__sender').order_by('-last_message_at', '-cid')
             
+            conversations = list(conversations)
+            statuses = get_statuses([conv.user_id for conv in conversations])
+
             data = []
             for conv in conversations:
                 conv_data = ConversationSerializer(conv).data
                 conv_data['user_details'] = UserSerializer(conv.user).data
                 
-                user_status = cache.get(f"user:{conv.user.id}:status", "offline")
-                conv_data['is_online'] = (user_status == "online")
+                conv_data['is_online'] = (statuses[str(conv.user_id)] == "online")
                 
-                conv_data['unread_count'] = conv.unread_count
+                conv_data['unread_count'] = conv.staff_unread_count
                 
                 data.append(conv_data)
             
             return Response(data, status=status.HTTP_200_OK)
         else:
             conversation = Conversation.objects.filter(
-                user=request.user
-            ).filter(
-                Exists(Message.objects.filter(conversation=OuterRef('pk')))
-            ).first()
+                user=request.user, last_message_at__isnull=False
+            ).select_related('last_message__sender').first()
             
             if not conversation:
                 return Response(
@@ -60,13 +57,8 @@ class ConversationView(APIView):
             response_data = serializer.data
             
             from users.models import CustomUser
-            staff_users = CustomUser.objects.filter(is_staff=True)
-            is_any_staff_online = False
-            for staff in staff_users:
-                staff_status = cache.get(f"user:{staff.id}:status", "offline")
-                if staff_status == "online":
-                    is_any_staff_online = True
-                    break
+            staff_ids = list(CustomUser.objects.filter(is_staff=True).values_list('id', flat=True))
+            is_any_staff_online = "online" in get_statuses(staff_ids).values()
             
             response_data['is_online'] = is_any_staff_online
             
@@ -91,6 +83,47 @@ class ConversationView(APIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
+class StaffInboxView(APIView):
+    permission_classes = [IsAdminUser]
+
+    # Filters: ?unread=true, ?online=true, ?assigned=me. There is no
+    # assignment model, so "assigned to me" means conversations this staff
+    # member has opened (they hold a read pointer in it). The online filter
+    # runs in SQL before paginating so pages stay full; its IN list is
+    # bounded by the number of users connected right now.
+    def get(self, request):
+        conversations = Conversation.objects.filter(
+            last_message_at__isnull=False
+        ).select_related('user').only(
+            'cid', 'slug', 'user', 'last_message', 'last_message_at',
+            'last_message_preview', 'staff_unread_count',
+            'user__first_name', 'user__last_name', 'user__email'
+        )
+
+        if request.query_params.get('unread') == 'true':
+            conversations = conversations.filter(staff_unread_count__gt=0)
+        if request.query_params.get('online') == 'true':
+            conversations = conversations.filter(user_id__in=get_online_members(online_set_name(False)))
+        if request.query_params.get('assigned') == 'me':
+            conversations = conversations.filter(
+                Exists(ReadPointer.objects.filter(conversation=OuterRef('pk'), user=request.user))
+            )
+
+        pagination = StaffInboxPagination()
+        page = pagination.paginate_queryset(conversations, request, view=self)
+        statuses = get_statuses([conv.user_id for conv in page])
+        serializer = InboxConversationSerializer(page, many=True, context={
+            'online_ids': {user_id for user_id, state in statuses.items() if state == "online"}
+        })
+
+        response = pagination.get_paginated_response(serializer.data)
+        # Sums only rows in the partial staff-unread index.
+        response.data['total_unread'] = Conversation.objects.filter(
+            staff_unread_count__gt=0
+        ).aggregate(total=Sum('staff_unread_count'))['total'] or 0
+        return response
+
+
 class MessageView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -115,10 +148,36 @@ class MessageView(APIView):
         search_query = request.query_params.get('search', None)
         if search_query:
             messages = messages.filter(Q(message__icontains=search_query))
-        
-        pagination = MessageInfiniteScrollPagination()
+
+        after = request.query_params.get('after', None)
+        since = request.query_params.get('since', None)
+        if since is not None:
+            try:
+                messages = messages.filter(seq__gt=int(since))
+            except ValueError:
+                return Response(
+                    {"detail": "since must be a sequence number"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            pagination = UnreadReplayPagination()
+        elif after is not None:
+            try:
+                messages = messages.filter(seq__gt=int(after))
+            except ValueError:
+                return Response(
+                    {"detail": "after must be a sequence number"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if request.query_params.get('unread') == 'true':
+                messages = messages & unread_messages(conversation, request.user)
+            pagination = UnreadReplayPagination()
+        else:
+            pagination = MessageInfiniteScrollPagination()
         paginated = pagination.paginate_queryset(messages, request)
-        serializer = MessageSerializer(paginated, many=True)
+        serializer = MessageSerializer(paginated, many=True, context={
+            'conversation': conversation,
+            'read_watermarks': read_watermarks(conversation)
+        })
         
         return pagination.get_paginated_response(serializer.data)
     
@@ -173,6 +232,7 @@ class NotificationView(APIView):
         read = request.query_params.get('type', None)
         if read:
             notificaton = notificaton.filter(is_read=read)
+        notificaton = notificaton.order_by('-created_at')
         serializer = NotificationSerializer(notificaton, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -184,5 +244,14 @@ class NotificationView(APIView):
         notification.is_read = True
         notification.save()
         serializer = NotificationSerializer(notification)
-        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)   
-    
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            **metrics.snapshot(),
+            "rate_limits": get_rate_limit_stats()
+        }, status=status.HTTP_200_OK)
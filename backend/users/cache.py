@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from .models import CustomUser
+
+
+def user_cache_config():
+    return getattr(settings, "USER_CACHE", {})
+
+
+def auth_user_key(user_id):
+    return f"auth_user:{user_id}"
+
+
+# What is cached per user: the auth checks plus the display fields the
+# socket context reads on connect. The password hash and the rest of the
+# row stay out of Redis; they load from the database if something reads
+# them.
+CACHED_FIELDS = ("id", "email", "first_name", "last_name", "is_active", "is_staff", "is_superuser")
+
+
+# Size- and TTL-bounded LRU in front of the Redis copy. Entries live at most
+# LOCAL_TTL seconds, which bounds how long another process can keep serving
+# a user after it was changed or deactivated.
+class LocalUserCache:
+    def __init__(self, max_size=10000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            fields, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return fields
+
+    def set(self, user_id, fields):
+        with self.lock:
+            self.entries[user_id] = (fields, time.monotonic() + self.ttl)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+_local_cache = None
+
+
+def get_local_cache():
+    global _local_cache
+    if _local_cache is None:
+        config = user_cache_config()
+        _local_cache = LocalUserCache(
+            max_size=config.get("LOCAL_MAX_SIZE", 10000),
+            ttl=config.get("LOCAL_TTL", 30),
+        )
+    return _local_cache
+
+
+# Process LRU, then Redis, then the database. Every call builds a fresh
+# instance, so one request mutating request.user can't leak into another.
+def get_cached_user(user_id):
+    user_id = str(user_id)
+    local_cache = get_local_cache()
+    fields = local_cache.get(user_id)
+    if fields is None:
+        fields = cache.get(auth_user_key(user_id))
+        if fields is None:
+            fields = CustomUser.objects.filter(id=user_id).values(*CACHED_FIELDS).first()
+            if fields is None:
+                return None
+            cache.set(auth_user_key(user_id), fields, timeout=user_cache_config().get("TTL", 300))
+        local_cache.set(user_id, fields)
+    # from_db takes the loaded values in model field order; the rest defer.
+    field_names = [
+        field.attname for field in CustomUser._meta.concrete_fields if field.attname in CACHED_FIELDS
+    ]
+    return CustomUser.from_db(None, field_names, [fields[name] for name in field_names])
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(auth_user_key(user_id))
+    get_local_cache().delete(str(user_id))
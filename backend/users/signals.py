@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .cache import invalidate_cached_user
+from .models import CustomUser
+
+
+# Every profile change, deactivation and password change goes through
+# save(), so this covers them all.
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_user_cache(sender, instance, **kwargs):
+    # delete() clears instance.pk before the commit callback runs.
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_cached_user(user_id))
@@ -1,3 +1,64 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import CachedJWTAuthentication
+from .cache import auth_user_key, get_cached_user, get_local_cache
+from .models import CustomUser
 
-# Create your tests here.
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CachedUserTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        get_local_cache().entries.clear()
+        self.user = CustomUser.objects.create_user(
+            email="ada@example.com", password="secret", first_name="Ada", last_name="Lovelace"
+        )
+
+    def save(self, instance, delete=False):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.delete() if delete else instance.save()
+
+    def test_cache_hit_skips_the_database(self):
+        get_cached_user(self.user.id)
+        with self.assertNumQueries(0):
+            user = get_cached_user(self.user.id)
+        self.assertEqual((user.id, user.email, user.first_name), (self.user.id, "ada@example.com", "Ada"))
+
+        # The Redis copy serves other processes, whose local cache is empty.
+        get_local_cache().entries.clear()
+        with self.assertNumQueries(0):
+            get_cached_user(self.user.id)
+
+    def test_password_hash_is_not_cached(self):
+        get_cached_user(self.user.id)
+        cached = cache.get(auth_user_key(self.user.id))
+        self.assertNotIn("password", cached)
+        self.assertNotIn(self.user.password, repr(cached))
+        # Still available to code that needs it, straight from the database.
+        self.assertEqual(get_cached_user(self.user.id).password, self.user.password)
+
+    def test_save_invalidates(self):
+        get_cached_user(self.user.id)
+        self.user.first_name = "Grace"
+        self.save(self.user)
+        self.assertIsNone(cache.get(auth_user_key(self.user.id)))
+        self.assertEqual(get_cached_user(self.user.id).first_name, "Grace")
+
+    def test_delete_invalidates(self):
+        user_id = self.user.id
+        get_cached_user(user_id)
+        self.save(self.user, delete=True)
+        self.assertIsNone(get_cached_user(user_id))
+
+    def test_deactivated_user_is_rejected(self):
+        token = AccessToken.for_user(self.user)
+        authentication = CachedJWTAuthentication()
+        self.assertEqual(authentication.get_user(token).id, self.user.id)
+
+        self.user.is_active = False
+        self.save(self.user)
+        with self.assertRaises(AuthenticationFailed):
+            authentication.get_user(token)
@@ -245,6 +245,27 @@ const IntegratedChatInterface = ({ userId, conversationId, socket, onConversatio
             }, 50);
           }
         }
+        else if (data.type === "unread_batch" && conversationId === lastConversationIdRef.current) {
+          setLiveMessages((prev) => {
+            const knownIds = new Set(prev.map(msg => msg.mid));
+            const replayed = data.messages
+              .filter(msg => !knownIds.has(msg.message_id))
+              .map(msg => ({
+                mid: msg.message_id,
+                message: msg.message || "",
+                image: msg.image,
+                message_type: msg.message_type,
+                sender: msg.sender,
+                sender_name: msg.sender_name,
+                sender_email: msg.sender_email,
+                timestamp: convertUTCtoNepal(msg.timestamp),
+                status: msg.status || MESSAGE_STATUS.DELIVERED,
+                is_read: false,
+              }));
+
+            return [...prev, ...replayed];
+          });
+        }
         else if (data.type === "read") {
           setLiveMessages(prev =>
             prev.map(msg =>